@@ -1,68 +1,111 @@
-from .parser import parse_yaml_url, get_url_content, parse_yaml_content
+from .plan import load_plan, PlanCache
+from .includes import HttpCache
 from .executors import NativeExecutor, DockerExecutor
-from .docker import make_docker_image
+from .docker import make_docker_image, use_docker_api
+from .container_pool import parse_pool_record
 import argparse
 import threading
 import os
 import pprint
-from .core import Core
-from .util import merge_dicts_and_lists, merge_dicts
+from .core import Core, parse_shard
+from .git_cache import GitMirrorCache
+from .step_cache import StepCache
+from .incremental import IncrementalState
+from .prefetch import reachable_pipeline_records, prefetch_repositories
+from .util import merge_dicts
 from .log import Logger
+from .report import RunReport
+from .history import RunHistory, print_stats
+from .metrics import Metrics, MetricsServer
+from .log_server import LogStreamServer, parse_listen_address
 import signal
+import sys
 import pkg_resources
 import asyncio
 
-def get_dictionaries(pathes):
-    dicts = []
-    for path in pathes:
-        content = get_url_content(path)
-        dct = parse_yaml_content(content)
-        if dct is not None:
-            if "include" in dct:
-                for include in dct["include"]:
-                    dicts.extend(get_dictionaries([include]))
-
-            dicts.append(dct)
-
-        # lines of content
-        lines = content.splitlines()
-        for l in lines:
-            if l.startswith("#!include"):
-                include_url = l[len("#!include"):].strip()
-                print("Include:", include_url)
-                dicts.extend(get_dictionaries([include_url]))
-    return dicts
-
-
 async def doit(logger, args):
-    print("DOIT")
+    logger.print("DOIT")
     logger.print("Start script:", args.scripts)
 
     filepathes = args.scripts
-    dct = {}
-
-    script_dictionaries = get_dictionaries(filepathes)
-    dct = merge_dicts_and_lists(*script_dictionaries)
+    plan = await load_plan(filepathes,
+                           cache=None if args.no_plan_cache else PlanCache(),
+                           http_cache=HttpCache(offline=args.offline))
+    dct = plan.config
 
-    if "docker" in dct:
-        if "script" in dct["docker"]:
-            make_docker_image(dct["docker"]["script"], name=dct["docker"]["name"])
-            args.docker = dct["docker"]["name"]
+    if args.compile:
+        if args.entrance is not None and args.entrance not in plan.pipeline_names():
+            raise Exception("Pipeline not found: " + args.entrance)
+        logger.print(f"Configuration is valid: {len(plan.sources)} sources, "
+                     f"pipelines: {', '.join(plan.pipeline_names())}")
+        return
 
     if args.debug:
-        pp = pprint.PrettyPrinter(indent=4)
-        pp.pprint(dct)
+        logger.print(pprint.pformat(dct, indent=4))
 
     if "script_executor" in dct:
         script_executor = dct["script_executor"]
     else:
         script_executor = "/bin/bash"
 
+    if "pipeline_template" in dct:
+        pipeline_template = dct["pipeline_template"]
+    else:
+        pipeline_template = {}
+
+    entrance = args.entrance
+    if entrance is None and len(dct["pipeline"]) == 1:
+        entrance = dct["pipeline"][0]["name"]
+
+    git_cache = None
+    if args.git_cache or args.prefetch or "git_cache" in dct:
+        git_cache_directory = dct.get("git_cache", None)
+        if not isinstance(git_cache_directory, str):
+            git_cache_directory = None
+        git_cache = GitMirrorCache(git_cache_directory)
+
+    # image build and repositories prefetch do not depend on each other
+    report = RunReport.instance()
+    preparations = []
+    if "docker" in dct:
+        if "script" in dct["docker"]:
+            preparations.append(report.measure(
+                "image", dct["docker"]["name"],
+                make_docker_image(dct["docker"]["script"],
+                                  name=dct["docker"]["name"],
+                                  cache_from=dct["docker"].get("cache_from", None),
+                                  buildkit=dct["docker"].get("buildkit", False))))
+            args.docker = dct["docker"]["name"]
+    if args.prefetch and entrance is not None:
+        records = reachable_pipeline_records(dct["pipeline"], pipeline_template, entrance)
+        preparations.append(report.measure(
+            "prefetch", "prefetch", prefetch_repositories(git_cache, records, args.prefetch_jobs)))
+    await asyncio.gather(*preparations)
+
+    if git_cache is not None:
+        if args.docker is not None:
+            # mirrors are read by clones inside the container under the same path
+            args.docker_opts += f" -v {git_cache.directory}:{git_cache.directory}:ro"
+
     executor = NativeExecutor(script_executor=script_executor)
     if args.docker is not None:
+        if args.docker_api:
+            use_docker_api(args.docker_socket)
+        pool_options = parse_pool_record(dct.get("docker", {}).get("pool", None))
+        if args.docker_pool is not None:
+            pool_options = merge_dicts(pool_options or {}, {"size": args.docker_pool})
         executor = DockerExecutor(image=args.docker,
                                   script_executor=script_executor,
-                                  additional_options=args.docker_opts)
+                                  additional_options=args.docker_opts,
+                                  script_delivery=args.docker_delivery,
+                                  pool_options=pool_options)
+
+    executor.git_cache = git_cache
+    if not args.no_step_cache:
+        executor.step_cache = StepCache(**dct.get("step_cache", {}))
+
+    if args.session or dct.get("session", False):
+        executor.session_mode = True
 
     if "matrix" in dct:
         matrix = dct["matrix"]
@@ -79,10 +122,23 @@ async def doit(logger, args):
     else:
         prefix = ""
 
-    if "pipeline_template" in dct:
-        pipeline_template = dct["pipeline_template"]
-    else:
-        pipeline_template = {}
+    jobs = 1
+    fail_fast = True
+    if "parallel" in dct:
+        parallel = dct["parallel"]
+        if isinstance(parallel, dict):
+            jobs = parallel.get("jobs", jobs)
+            fail_fast = parallel.get("fail_fast", fail_fast)
+        else:
+            jobs = parallel
+    if args.jobs is not None:
+        jobs = args.jobs
+    if args.fail_fast is not None:
+        fail_fast = args.fail_fast
+
+    incremental_state = None
+    if args.incremental or dct.get("incremental", False):
+        incremental_state = IncrementalState(force=args.force)
 
     hide_links = False
     if "security" in dct:
@@ -98,24 +154,69 @@ async def doit(logger, args):
                 on_failure_records=dct.get("on_failure", None),
                 pipeline_template=pipeline_template,
                 security_options={"hide_links": hide_links},
-                timeout=timeout,)
+                timeout=timeout,
+                jobs=jobs,
+                fail_fast=fail_fast,
+                shard=parse_shard(args.shard) if args.shard else None,
+                incremental_state=incremental_state,
+                undefined_variables="error" if args.strict else dct.get("undefined_variables", "warn"))
 
-    if args.entrance is not None:
+    if entrance is not None:
         if args.debug:
-            logger.print("Entrance:", args.entrance)
-        await core.execute_entrypoint(args.entrance)
-    elif len(dct["pipeline"]) == 1:
-        await core.execute_entrypoint(dct["pipeline"][0]["name"])
+            logger.print("Entrance:", entrance)
+        results = await core.execute_entrypoint(entrance)
+        if not args.no_history:
+            history = RunHistory()
+            try:
+                history.record_run(report, results, scripts=args.scripts, entrance=entrance)
+            finally:
+                history.close()
+        if args.report:
+            report.write(args.report)
+        metrics = Metrics.instance()
+        if metrics.enabled:
+            metrics.finish_run()
+        if args.metrics_textfile:
+            metrics.write_textfile(args.metrics_textfile)
     else:
         logger.print("Entrance is not specified. Use --entrance to specify it.")
 
 
-def sigint_handler(signum, frame):
+def sigint_handler(main_task):
+    # runs as event loop callback, not inside of an interrupted frame,
+    # so the logger queue can not be interrupted while it is locked
     Logger.instance().print("SIGINT received. Canceling...")
-    Logger.instance().close_log()
-    exit(-1)
+    main_task.cancel()
+
+def stats_main(argv):
+    parser = argparse.ArgumentParser(prog='bonesinger stats',
+                                     description='Step durations from run history')
+    parser.add_argument('--pipeline', type=str, default=None, help='Only steps of this pipeline')
+    parser.add_argument('-n', '--step', type=str, default=None, help='Only steps with this name')
+    parser.add_argument('--days', type=float, default=30, help='Use runs of last N days')
+    parser.add_argument('--top', type=int, default=20, help='Number of rows in tables')
+    parser.add_argument('--baseline', type=int, default=10,
+                        help='Number of previous runs a step duration is compared with')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='Duration over threshold * baseline median is a regression')
+    parser.add_argument('--min_increase', type=float, default=1.0,
+                        help='Ignore regressions smaller than this number of seconds')
+    args = parser.parse_args(argv)
+
+    history = RunHistory()
+    try:
+        print_stats(history, pipeline=args.pipeline, step=args.step, days=args.days,
+                    top=args.top, baseline=args.baseline, threshold=args.threshold,
+                    min_increase=args.min_increase)
+    finally:
+        history.close()
+
 
 async def async_main():
+    if sys.argv[1:2] == ["stats"]:
+        stats_main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description='bonesinger')
     # add multiple arguments
     parser.add_argument('scripts', nargs='*', type=str, help='Path to script')
@@ -126,8 +227,67 @@ async def async_main():
                         help='Docker image to use', default=None)
     parser.add_argument('--docker_opts', type=str,
                         help='Docker image to use', default="")
-    parser.add_argument('-n', '--step', help='step name',
+    parser.add_argument('--docker_delivery', type=str, choices=["file", "stdin"],
+                        help='How scripts are passed to the container: '
+                             'temporary file and docker cp, or docker exec stdin',
+                        default="file")
+    parser.add_argument('--docker_api', action='store_true',
+                        help='Talk to Docker Engine API over unix socket instead of docker CLI')
+    parser.add_argument('--docker_socket', type=str, default=None,
+                        help='Docker Engine socket path (default: DOCKER_HOST or /var/run/docker.sock)')
+    parser.add_argument('--docker_pool', type=int, default=None,
+                        help='Keep up to N warm containers of the image between runs')
+    parser.add_argument('--git_cache', action='store_true',
+                        help='Clone repositories from local mirrors in ~/.bonesinger-git')
+    parser.add_argument('--no_step_cache', action='store_true',
+                        help='Execute steps with cache: records without using step cache')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Skip git pipelines whose remote commit has not changed since last success')
+    parser.add_argument('--force', action='store_true',
+                        help='Execute all pipelines in incremental mode, but still record results')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='Update git mirrors of all reachable pipelines before execution')
+    parser.add_argument('--prefetch_jobs', type=int, default=8,
+                        help='Number of repositories prefetched at the same time')
+    parser.add_argument('--strict', action='store_true',
+                        help='Fail on {{variables}} without value instead of warning')
+    parser.add_argument('--compile', action='store_true',
+                        help='Resolve and validate scripts without executing them')
+    parser.add_argument('--no_plan_cache', action='store_true',
+                        help='Parse scripts without using cached plans')
+    parser.add_argument('--offline', action='store_true',
+                        help='Use cached copies of http includes without network access')
+    parser.add_argument('-n', '--step', help='step name (filter of --lastlog)',
                         default="", required=False)
+    parser.add_argument('--pipeline', type=str, default=None,
+                        help='Show only records of this pipeline in --lastlog')
+    parser.add_argument('--tail', type=int, default=None,
+                        help='Show only last N lines in --lastlog')
+    parser.add_argument('--failed-only', dest='failed_only', action='store_true',
+                        help='Show only failed steps in --lastlog')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of matrix values executed at the same time')
+    parser.add_argument('--fail-fast', dest='fail_fast', action='store_const', const=True,
+                        default=None, help='Stop all matrix values on first failure')
+    parser.add_argument('--keep-going', dest='fail_fast', action='store_const', const=False,
+                        help='Execute all matrix values even if some of them fail')
+    parser.add_argument('--shard', type=str, default=None,
+                        help='Execute only k-th of n parts of the matrix (k/n)')
+    parser.add_argument('--session', action='store_true',
+                        help='Run steps of each pipeline in one persistent shell')
+    parser.add_argument('--no_history', action='store_true',
+                        help='Do not record the run in ~/.bonesinger-cache/history.sqlite')
+    parser.add_argument('--report', type=str, default=None,
+                        help='Write timing and resource usage report (report.json) '
+                             'and Chrome trace (trace.json) to directory')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Serve OpenMetrics on [host:]port/metrics (localhost by default)')
+    parser.add_argument('--metrics_textfile', type=str, default=None,
+                        help='Write metrics at the end of run to file for node_exporter '
+                             'textfile collector')
+    parser.add_argument('--log_server', type=str, default=None,
+                        help='Stream log records as server-sent events on [host:]port '
+                             '(localhost by default)')
     parser.add_argument('--version', action='store_true', help='Show version')
     args = parser.parse_args()
 
@@ -144,19 +304,40 @@ async def async_main():
         exit(0)
 
     if args.lastlog:
-        Logger.print_last_log()
+        Logger.print_last_log(pipeline=args.pipeline, step=args.step,
+                              tail=args.tail, failed_only=args.failed_only)
         return
 
     logger = Logger.instance()
     logger.init(directory=None)
 
-    signal.signal(signal.SIGINT, sigint_handler)
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGINT, sigint_handler, asyncio.current_task())
 
     if len(args.scripts) == 0:
         logger.print("No script given.")
     else:
         logger.print("bonesinger version:", __version__)
-        await doit(logger, args)
+        log_server = None
+        if args.log_server:
+            log_server = LogStreamServer(*parse_listen_address(args.log_server))
+            await log_server.start()
+        metrics_server = None
+        if args.metrics or args.metrics_textfile:
+            Metrics.instance().enable()
+        if args.metrics:
+            metrics_server = MetricsServer(Metrics.instance(), *parse_listen_address(args.metrics))
+            await metrics_server.start()
+        try:
+            await doit(logger, args)
+        except asyncio.CancelledError:
+            logger.close_log()
+            exit(-1)
+        finally:
+            if metrics_server is not None:
+                await metrics_server.stop()
+            if log_server is not None:
+                await log_server.stop()
 
     logger.close_log()
 
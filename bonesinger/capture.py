@@ -0,0 +1,95 @@
+import collections
+import tempfile
+
+# output of full capture over this size is kept in a temporary file
+DEFAULT_MAX_MEMORY = 16 * 1024 * 1024
+
+
+def parse_capture_record(record):
+    """Normalize step 'capture:' record:
+    none, full, {tail: N} or {max_memory: bytes} (full with memory cap)."""
+    if record in ("none", "full"):
+        return {"mode": record}
+    if isinstance(record, dict):
+        if "tail" in record:
+            return {"mode": "tail", "lines": int(record["tail"])}
+        if "max_memory" in record:
+            return {"mode": "full", "max_memory": int(record["max_memory"])}
+    raise Exception("Invalid step capture record: " + str(record))
+
+
+def make_capture(record):
+    if record["mode"] == "none":
+        return NoCapture()
+    if record["mode"] == "tail":
+        return TailCapture(record["lines"])
+    return FullCapture(record.get("max_memory", DEFAULT_MAX_MEMORY))
+
+
+class NoCapture:
+    def append(self, line):
+        pass
+
+    def getvalue(self):
+        return ""
+
+    def close(self):
+        pass
+
+
+class TailCapture:
+    """Last lines of output."""
+
+    def __init__(self, lines):
+        self.lines = collections.deque(maxlen=lines)
+
+    def append(self, line):
+        self.lines.append(line)
+
+    def getvalue(self):
+        return "".join(self.lines)
+
+    def close(self):
+        pass
+
+
+class FullCapture:
+    """Whole output. Lines are collected in a list and joined once;
+    after max_memory characters they go to a temporary file instead."""
+
+    def __init__(self, max_memory=DEFAULT_MAX_MEMORY):
+        self.max_memory = max_memory
+        self.chunks = []
+        self.size = 0
+        self.file = None
+
+    def append(self, line):
+        if self.file is not None:
+            self.file.write(line)
+            return
+        self.chunks.append(line)
+        self.size += len(line)
+        if self.size > self.max_memory:
+            self.file = tempfile.TemporaryFile("w+", encoding="utf-8", prefix="bonesinger-output-")
+            self.file.write("".join(self.chunks))
+            self.chunks = []
+
+    def getvalue(self):
+        if self.file is None:
+            return "".join(self.chunks)
+        self.file.seek(0)
+        return self.file.read()
+
+    def iter_chunks(self, size=1024 * 1024):
+        """Output in pieces, read back from the temporary file without
+        joining it in memory."""
+        if self.file is None:
+            yield from self.chunks
+            return
+        self.file.seek(0)
+        yield from iter(lambda: self.file.read(size), "")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
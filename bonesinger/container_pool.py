@@ -0,0 +1,173 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from .docker import (
+    start_docker_container,
+    exec_in_docker_container,
+    stop_docker_container,
+    is_docker_container_running)
+from .log import Logger
+
+logger = Logger.instance()
+
+
+def parse_pool_record(record):
+    """Normalize docker 'pool:' record: true (default options), false,
+    a pool size or a dict of ContainerPool options. None if disabled."""
+    if record is None or record is False:
+        return None
+    if record is True:
+        return {}
+    if isinstance(record, int):
+        return {"size": record}
+    if isinstance(record, dict):
+        return dict(record)
+    raise Exception("Invalid docker pool record: " + str(record))
+
+
+class ContainerPool:
+    """Warm docker containers kept running between checkouts and between
+    bonesinger runs. Idle containers are listed in a state file under
+    ~/.bonesinger-pool/ keyed by image, interpreter and run options, so
+    concurrent runs share the pool under a file lock.
+
+    A returned container is stopped and a fresh one is started in the
+    background in its place, so steps never see what earlier checkouts
+    installed. With reuse (or non-zero max_uses) the returned container
+    itself is kept: directories created in it and temporary scripts are
+    removed, anything installed elsewhere stays. Containers which served
+    max_uses checkouts, were idle longer than idle_timeout seconds or do
+    not fit into size are stopped."""
+
+    _default_directory = os.path.expanduser("~/.bonesinger-pool/")
+
+    def __init__(self, image, script_executor, additional_options="",
+                 size=2, idle_timeout=3600, max_uses=0, reuse=False, directory=None):
+        self.image = image
+        self.script_executor = script_executor
+        self.additional_options = additional_options
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_uses = max_uses
+        self.reuse = reuse or max_uses > 0
+        self.directory = os.path.expanduser(directory or ContainerPool._default_directory)
+        self.key = hashlib.sha256(
+            f"{image}\n{script_executor}\n{additional_options}".encode("utf-8")).hexdigest()[:16]
+        self.uses = {}
+        # threads starting replacements of returned containers
+        self.replacing = []
+        os.makedirs(self.directory, exist_ok=True)
+
+    def state_path(self):
+        return os.path.join(self.directory, self.key + ".json")
+
+    def locked_state(self):
+        """Open lock file; the caller holds the lock until it is closed."""
+        lock = open(os.path.join(self.directory, self.key + ".lock"), "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def read_state(self):
+        try:
+            with open(self.state_path(), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"idle": {}}
+
+    def write_state(self, state):
+        tmp_path = self.state_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path())
+
+    def evict(self, state):
+        """Drop expired and surplus idle containers from state,
+        return their names."""
+        now = time.time()
+        idle = state["idle"]
+        evicted = [name for name, entry in idle.items()
+                   if now - entry["last_used"] > self.idle_timeout]
+        for name in evicted:
+            del idle[name]
+        # newest are kept
+        surplus = sorted(idle, key=lambda name: idle[name]["last_used"])[:max(0, len(idle) - self.size)]
+        for name in surplus:
+            del idle[name]
+        return evicted + surplus
+
+    def stop(self, names):
+        for name in names:
+            logger.print(f"Container pool: stop {name}")
+            stop_docker_container(name)
+
+    def checkout(self):
+        """Return name of a running container, warm one if possible."""
+        with self.locked_state():
+            state = self.read_state()
+            evicted = self.evict(state)
+            candidates = sorted(state["idle"], key=lambda name: state["idle"][name]["last_used"],
+                                reverse=True)
+            name = None
+            for candidate in candidates:
+                entry = state["idle"].pop(candidate)
+                if is_docker_container_running(candidate):
+                    name = candidate
+                    self.uses[name] = entry["uses"]
+                    break
+                evicted.append(candidate)
+            self.write_state(state)
+        self.stop(evicted)
+
+        if name is not None:
+            logger.print(f"Container pool: reuse {name}")
+            return name
+
+        name = self.start()
+        self.uses[name] = 0
+        return name
+
+    def start(self):
+        return start_docker_container(self.image, self.script_executor,
+                                      f"{self.additional_options} --label bonesinger.pool={self.key}")
+
+    def add_idle(self, name, uses):
+        with self.locked_state():
+            state = self.read_state()
+            state["idle"][name] = {"last_used": time.time(), "uses": uses}
+            evicted = self.evict(state)
+            self.write_state(state)
+        self.stop(evicted)
+
+    def replace(self, name):
+        """Stop used container and make a fresh idle one instead."""
+        try:
+            self.stop([name])
+            self.add_idle(self.start(), 0)
+        except Exception as e:
+            logger.print(f"Container pool: cannot replace {name}: {e}")
+
+    def checkin(self, name, directories=()):
+        """Replace container by a fresh one, reset it for reuse or stop it."""
+        uses = self.uses.pop(name, 0) + 1
+        if self.size <= 0 or (self.max_uses and uses >= self.max_uses):
+            self.stop([name])
+            return
+
+        if not self.reuse:
+            thread = threading.Thread(target=self.replace, args=(name,))
+            thread.start()
+            self.replacing.append(thread)
+            return
+
+        paths = " ".join(list(directories) + ["/tmp/*.tmp"])
+        exec_in_docker_container(name, f"sh -c 'rm -rf {paths}'")
+        self.add_idle(name, uses)
+
+    def finish(self):
+        """Wait until replacement containers are started."""
+        for thread in self.replacing:
+            thread.join()
+        self.replacing = []
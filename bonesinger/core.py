@@ -1,32 +1,73 @@
 from .executors import StepExecutor
 from .step import RunStep
 from .pipeline import Pipeline, PipelineTimeoutException
-from .util import strong_key_format, merge_dicts
+from .util import merge_dicts
+from .template import Template, UNDEFINED_MODES
 import tempfile
 import os
 from git import Repo
 import traceback
 from .log import Logger
+from .report import RunReport
+from .metrics import Metrics
 import asyncio
+import copy
+import itertools
+import time
 
 logger = Logger.instance()
 
 
-def matrix_iterator(matrix):
-    def prod(lst):
-        res = 1
-        for x in lst:
-            res *= x
-        return res
-
-    keys = sorted(matrix.keys())
+def matrix_iterator(matrix, shard=None):
+    """Lazily yield matrix values: cartesian product of all axes (keys in
+    sorted order) without combinations matching some 'exclude' entry,
+    followed by 'include' entries as additional values.
+    An exclude entry matches a value if all its keys have equal values.
+    shard=(k, n) keeps only every n-th value starting from the k-th (1-based)."""
+    excludes = matrix.get("exclude", [])
+    includes = matrix.get("include", [])
+    keys = sorted(key for key in matrix if key not in ("exclude", "include"))
     values_list = [matrix[key] for key in keys]
-    count_of_elements = prod([len(values) for values in values_list])
-    for i in range(count_of_elements):
-        matrix_value = {}
-        for j in range(len(keys)):
-            matrix_value[keys[j]] = values_list[j][i % len(values_list[j])]
-        yield matrix_value
+
+    def is_excluded(matrix_value):
+        for exclude in excludes:
+            if all(matrix_value.get(key) == value for key, value in exclude.items()):
+                return True
+        return False
+
+    def expand():
+        for combination in itertools.product(*values_list):
+            matrix_value = dict(zip(keys, combination))
+            if not is_excluded(matrix_value):
+                yield matrix_value
+        for include in includes:
+            yield dict(include)
+
+    for index, matrix_value in enumerate(expand()):
+        if shard is None or index % shard[1] == shard[0] - 1:
+            yield matrix_value
+
+
+def parse_shard(text):
+    """Parse 'k/n' shard specification into (k, n) tuple."""
+    try:
+        k, n = (int(x) for x in text.split("/"))
+    except ValueError:
+        raise Exception("Invalid shard, expected k/n: " + text)
+    if n < 1 or k < 1 or k > n:
+        raise Exception("Invalid shard, expected 1 <= k <= n: " + text)
+    return k, n
+
+
+def index_by_name(records, kind):
+    """Map record names to records, rejecting duplicates."""
+    index = {}
+    for record in records:
+        name = record["name"]
+        if name in index:
+            raise Exception(f"Duplicate {kind} name: {name}")
+        index[name] = record
+    return index
 
 
 def sanitize_url(text):
@@ -49,17 +90,32 @@ class Core:
                  on_failure_records: dict,
                  pipeline_template: list,
                  security_options: dict,
-                 timeout: int):
+                 timeout: int,
+                 jobs: int = 1,
+                 fail_fast: bool = True,
+                 shard: tuple = None,
+                 incremental_state=None,
+                 undefined_variables: str = "warn"):
         self.pipeline_template = pipeline_template
         self.executor = executor
         self.matrix = matrix
-        self.prefix = prefix
+        self.prefix = Template(prefix)
         self.debug = debug
-        self.pipelines = self.parse_pipelines(pipeline_records)
+        self.pipeline_records = pipeline_records
+        self.pipeline_index = index_by_name(pipeline_records, "pipeline")
+        self.template_index = index_by_name(pipeline_template, "pipeline template")
+        self.pipelines = {}
         self.on_success_script = self.make_task_list(on_success_records)
         self.on_failure_script = self.make_task_list(on_failure_records)
         self.security_options = security_options
         self.timeout = timeout
+        self.jobs = max(1, jobs)
+        self.fail_fast = fail_fast
+        self.shard = shard
+        self.incremental_state = incremental_state
+        if undefined_variables not in UNDEFINED_MODES:
+            raise Exception("Invalid undefined_variables mode: " + str(undefined_variables))
+        self.undefined_variables = undefined_variables
 
     def make_task_list(self, records) -> list:
         """make list of Step objects from records"""
@@ -78,10 +134,12 @@ class Core:
     def is_debug_mode(self):
         return self.debug
 
-    def compile_pipeline_record(self, name, template, subst):
+    @staticmethod
+    def compile_pipeline_record(name, template, subst):
         def subst_value(value):
             if isinstance(value, str):
-                return strong_key_format(value, subst)
+                # placeholders which are not template args are substituted later
+                return Template(value).render(subst, undefined="keep")
             elif isinstance(value, list):
                 return [subst_value(x) for x in value]
             elif isinstance(value, dict):
@@ -94,23 +152,24 @@ class Core:
 
         return rec
 
-    def parse_pipelines(self, list_of_pipeline_records):
-        pipelines = []
-        for pipeline_record in list_of_pipeline_records:
-            pipelines.append(Pipeline.from_record(pipeline_record, core=self))
-        return pipelines
+    def find_pipeline_record(self, name: str):
+        if name not in self.pipeline_index:
+            raise Exception("Pipeline not found: " + name)
+        return self.pipeline_index[name]
 
     def find_pipeline(self, name: str):
-        for pipeline in self.pipelines:
-            if pipeline.name == name:
-                return pipeline
-        raise Exception("Pipeline not found: " + name)
+        """Pipeline object by name. Pipelines are constructed (and get
+        their workspaces) on first request, so unreachable ones cost nothing."""
+        pipeline = self.pipelines.get(name, None)
+        if pipeline is None:
+            pipeline = Pipeline.from_record(self.find_pipeline_record(name), core=self)
+            self.pipelines[name] = pipeline
+        return pipeline
 
     def find_pipeline_template(self, name):
-        for template in self.pipeline_template:
-            if template["name"] == name:
-                return template
-        raise Exception("Pipeline template not found: " + name)
+        if name not in self.template_index:
+            raise Exception("Pipeline template not found: " + name)
+        return self.template_index[name]
 
     def create_build_directory_and_change_it(self):
         logger.print("Create core workspace")
@@ -118,45 +177,140 @@ class Core:
         self.executor.chdir(temporary_directory)
         self.workspace = temporary_directory
 
-    async def execute_entrypoint(self, entrypoint: str):
+    def make_cell_core(self, executor):
+        """Copy of core with its own executor context and pipeline objects.
+        Matrix values executed on different copies do not share workspaces,
+        current directories or pipeline variables."""
+        cell = copy.copy(self)
+        cell.executor = executor
+        cell.pipelines = {}
+        return cell
+
+    async def execute_matrix_value(self, entrypoint: str, matrix_value: dict):
+        """Execute entrypoint for one matrix value.
+        Returns status ("success", "failed" or "timeout") and error message."""
         self.create_build_directory_and_change_it()
         pipeline = self.find_pipeline(entrypoint)
-        for matrix_value in matrix_iterator(self.matrix):
-            try:
-                if self.debug:
-                    logger.print(
-                        f"Execute pipeline {pipeline.name} for matrix value: {matrix_value}")
-                
-                task = asyncio.create_task(pipeline.execute(executor=self.executor,
-                    matrix_value=matrix_value,
-                    prefix=self.prefix,
-                    subst={}))
-
-                await asyncio.wait_for(task, timeout=self.timeout)
-            except asyncio.TimeoutError:            
-                current_directory = os.getcwd()
-                logger.print("Timeout")
-                logger.print("Location: " + current_directory)
-                logger.print("Traceback: " + traceback.format_exc())
-                await self.on_failure(pipeline, matrix_value, f"Global timeout exceeded ({self.timeout}s)")
-                break
-            except PipelineTimeoutException as e:
-                current_directory = os.getcwd()
-                logger.print("Timeout")
-                logger.print("Location: " + current_directory)
-                logger.print("Traceback: " + traceback.format_exc())
-                await self.on_failure(pipeline, matrix_value, e)
-            except Exception as e:
-                current_directory = os.getcwd()
-                logger.print("Exception: " + str(e))
-                logger.print("Location: " + current_directory)
-                logger.print("Traceback: " + traceback.format_exc())
-                await self.on_failure(pipeline, matrix_value, e)
-                break
-
-            await self.on_success(pipeline, matrix_value)
+        try:
+            if self.debug:
+                logger.print(
+                    f"Execute pipeline {pipeline.name} for matrix value: {matrix_value}")
+
+            task = asyncio.create_task(pipeline.execute(executor=self.executor,
+                matrix_value=matrix_value,
+                prefix=self.prefix,
+                subst={}))
 
+            await asyncio.wait_for(task, timeout=self.timeout or None)
+        except asyncio.TimeoutError:
+            logger.print("Timeout")
+            logger.print("Location: " + str(self.executor.current_directory))
+            logger.print("Traceback: " + traceback.format_exc())
+            error = f"Global timeout exceeded ({self.timeout}s)"
+            await self.on_failure(pipeline, matrix_value, error)
+            return "timeout", error
+        except PipelineTimeoutException as e:
+            logger.print("Timeout")
+            logger.print("Location: " + str(self.executor.current_directory))
+            logger.print("Traceback: " + traceback.format_exc())
+            await self.on_failure(pipeline, matrix_value, e)
+            return "timeout", str(e)
+        except Exception as e:
+            logger.print("Exception: " + str(e))
+            logger.print("Location: " + str(self.executor.current_directory))
+            logger.print("Traceback: " + traceback.format_exc())
+            await self.on_failure(pipeline, matrix_value, e)
+            return "failed", str(e)
+
+        await self.on_success(pipeline, matrix_value)
+        return "success", ""
+
+    async def execute_cell(self, entrypoint, result, semaphore, abort):
+        metrics = Metrics.instance()
+        if metrics.enabled:
+            metrics.add("bonesinger_cells_queued", 1)
+        try:
+            await semaphore.acquire()
+        finally:
+            if metrics.enabled:
+                metrics.add("bonesinger_cells_queued", -1)
+        try:
+            await self.execute_acquired_cell(entrypoint, result, abort)
+        finally:
+            semaphore.release()
+
+    async def execute_acquired_cell(self, entrypoint, result, abort):
+        if abort.is_set():
+            result["status"] = "skipped"
+            return
+        start = time.time()
+        executor = await asyncio.to_thread(self.executor.checkout_cell_executor)
+        try:
+            cell = self.make_cell_core(executor)
+            with logger.context(matrix=result["matrix_value"]), \
+                    RunReport.instance().span("cell", entrypoint) as span:
+                status, error = await cell.execute_matrix_value(
+                    entrypoint, result["matrix_value"])
+                span["status"] = status
+        except asyncio.CancelledError:
+            status, error = "cancelled", "cancelled by fail-fast"
+        except Exception as e:
+            # e.g. invalid pipeline record found on construction
+            logger.print("Exception: " + str(e))
+            status, error = "failed", str(e)
+        finally:
+            await asyncio.to_thread(self.executor.release_cell_executor, executor)
+        result["status"] = status
+        result["error"] = error
+        result["duration"] = time.time() - start
+        if status != "success" and self.fail_fast:
+            abort.set()
+
+    async def execute_entrypoint(self, entrypoint: str):
+        """Execute entrypoint for every matrix value, up to self.jobs values
+        at the same time. In fail-fast mode the first failure cancels running
+        values and skips the ones not started yet; otherwise all values run.
+        Returns list of per-value results."""
+        self.find_pipeline_record(entrypoint)
+        semaphore = asyncio.Semaphore(self.jobs)
+        abort = asyncio.Event()
+        results = []
+        tasks = []
+        for matrix_value in matrix_iterator(self.matrix, shard=self.shard):
+            result = {"matrix_value": matrix_value, "status": "pending",
+                      "error": "", "duration": 0.0}
+            results.append(result)
+            tasks.append(asyncio.create_task(
+                self.execute_cell(entrypoint, result, semaphore, abort)))
+
+        async def cancel_on_abort():
+            await abort.wait()
+            for task in tasks:
+                task.cancel()
+
+        watcher = asyncio.create_task(cancel_on_abort())
+        await asyncio.gather(*tasks, return_exceptions=True)
+        watcher.cancel()
+
+        for result in results:
+            if result["status"] == "pending":
+                result["status"] = "skipped"
+
+        self.report_results(results)
+        if self.incremental_state is not None:
+            self.incremental_state.report()
         self.executor.finish_executor()
+        return results
+
+    def report_results(self, results):
+        if len(results) <= 1 and not self.debug:
+            return
+        logger.print("Matrix results:")
+        for result in results:
+            line = f"  {result['status']:<9} {result['duration']:8.1f}s  {result['matrix_value']}"
+            if result["error"]:
+                line += f": {result['error']}"
+            logger.print(line)
 
     async def on_success(self, pipeline, matrix_value):
         if self.security_options["hide_links"]:
@@ -1,24 +1,52 @@
 import subprocess
 import time
-import fcntl
-import sys
 import os
-import tempfile
+import shlex
+import hashlib
+import fnmatch
+import asyncio
+from .docker_api import DockerClient, DockerAPIError, parse_run_options, default_socket_path
+from .util import read_lines
 from .log import Logger
 
 logger = Logger.instance()
 
+# Engine API client used instead of docker CLI when enabled
+_api_client = None
+
+
+def use_docker_api(socket_path=None):
+    global _api_client
+    _api_client = DockerClient(socket_path or default_socket_path())
+    return _api_client
+
+
+def docker_api_client():
+    return _api_client
+
 
 def start_docker_container(image, cmd, additional_options=""):
-    print(f"Starting docker container {image}")
+    logger.print(f"Starting docker container {image}")
     random_name = f"{time.time()}"
+    if _api_client is not None:
+        config, host_config = parse_run_options(additional_options)
+        _api_client.create_container(image, shlex.split(cmd), random_name,
+                                     config=config, host_config=host_config)
+        _api_client.start_container(random_name)
+        return random_name
+
     cmd = f"docker run {additional_options} -it -d --name {random_name} {image} {cmd}"
-    print("Start cmd: ",cmd)
+    logger.print("Start cmd: ", cmd)
     subprocess.run(cmd, shell=True)
     return random_name
 
 
 def exec_in_docker_container(container_name, cmd):
+    if _api_client is not None:
+        # a shell in the container, like the one of 'docker exec' command line
+        _, output = _api_client.exec_run(container_name, ["sh", "-c", cmd])
+        return output.strip()
+
     cmd = f"docker exec {container_name} {cmd}"
 
     # execute and get output from command
@@ -28,7 +56,24 @@ def exec_in_docker_container(container_name, cmd):
     return output
 
 
+def run_in_docker_container(container_name, args):
+    """Run argument list in container without shell.
+    Return exit code, stdout and stderr."""
+    if _api_client is not None:
+        return _api_client.exec_output(container_name, args)
+
+    proc = subprocess.run(["docker", "exec", container_name] + args,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return (proc.returncode, proc.stdout.decode("utf-8", errors="replace"),
+            proc.stderr.decode("utf-8", errors="replace"))
+
+
 def stop_docker_container(container_name):
+    if _api_client is not None:
+        _api_client.stop_container(container_name)
+        _api_client.remove_container(container_name)
+        return
+
     cmd = f"docker stop {container_name}"
     subprocess.run(cmd, shell=True)
 
@@ -36,47 +81,147 @@ def stop_docker_container(container_name):
     subprocess.run(cmd, shell=True)
 
 
-def upload_file_to_docker_container(container_name, file_path, dest_path):
-    cmd = f"docker cp {file_path} {container_name}:{dest_path}"
-    subprocess.run(cmd, shell=True)
-
+def is_docker_container_running(container_name):
+    if _api_client is not None:
+        try:
+            return _api_client.inspect_container(container_name)["State"]["Running"]
+        except DockerAPIError:
+            return False
 
-def make_docker_image(content, name):
-    # create temporary Dockerfile
-    temporary_dockerfile = tempfile.NamedTemporaryFile(mode="w", delete=False)
-    temporary_dockerfile.write(content)
-    temporary_dockerfile.close()
+    cmd = ["docker", "inspect", "-f", "{{.State.Running}}", container_name]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return proc.stdout.decode("utf-8").strip() == "true"
 
-    logger.print(f"Build docker image '{name}' from Dockerfile: " + temporary_dockerfile.name)
 
-    cmd = f"docker build -t {name} -f {temporary_dockerfile.name} ."
-    proc = subprocess.Popen(cmd, shell=True,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
+def upload_file_to_docker_container(container_name, file_path, dest_path):
+    if _api_client is not None:
+        _api_client.upload_file(container_name, file_path, dest_path)
+        return
 
-    # set non-blocking output
-    fcntl.fcntl(proc.stdout, fcntl.F_SETFL, fcntl.fcntl(
-        proc.stdout, fcntl.F_GETFL) | os.O_NONBLOCK)
+    cmd = f"docker cp {file_path} {container_name}:{dest_path}"
+    subprocess.run(cmd, shell=True)
 
 
-#    output = ""
-    while True:
-        # read stdout
-        try:
-            line = proc.stdout.read()
-            if line:
-                print(line.decode("utf-8").strip())
-        #        output += line.decode("utf-8")
-        except Exception as e:
-            logger.print(e)
-            pass
-
-        sys.stdout.flush()
-
-        # check if process is finished
-        if proc.poll() is not None:
-            break
-
-        # sleep for 0.1 second
-        time.sleep(0.1)
+def read_dockerignore(context):
+    """Rules of .dockerignore in context as (exception, pattern parts)."""
+    rules = []
+    try:
+        with open(os.path.join(context, ".dockerignore"), "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return rules
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        exception = line.startswith("!")
+        pattern = os.path.normpath(line.lstrip("!").strip().lstrip("/"))
+        rules.append((exception, pattern.split("/")))
+    return rules
+
+
+def match_dockerignore_pattern(pattern_parts, path_parts):
+    """Pattern matches the path or one of its parent directories;
+    "**" matches any number of directories."""
+    if not pattern_parts:
+        return True
+    if pattern_parts[0] == "**":
+        return any(match_dockerignore_pattern(pattern_parts[1:], path_parts[index:])
+                   for index in range(len(path_parts) + 1))
+    return bool(path_parts) and fnmatch.fnmatchcase(path_parts[0], pattern_parts[0]) \
+        and match_dockerignore_pattern(pattern_parts[1:], path_parts[1:])
+
+
+def is_dockerignored(rules, path):
+    """The last matching rule decides, like in docker build."""
+    ignored = False
+    parts = path.split("/")
+    for exception, pattern_parts in rules:
+        if match_dockerignore_pattern(pattern_parts, parts):
+            ignored = not exception
+    return ignored
+
+
+def hash_build_context(content, context):
+    """Hash of Dockerfile content and, if it copies files, of context files
+    which docker sends to the daemon (.dockerignore is respected)."""
+    digest = hashlib.sha256(content.encode("utf-8"))
+    instructions = [line.split(None, 1)[0].upper() for line in content.splitlines() if line.strip()]
+    if "COPY" not in instructions and "ADD" not in instructions:
+        return digest.hexdigest()
+
+    rules = read_dockerignore(context)
+    # without exceptions nothing below an ignored directory is sent
+    prune = not any(exception for exception, _ in rules)
+    for root, dirs, files in os.walk(context):
+        directory = os.path.relpath(root, context)
+        prefix = "" if directory == "." else directory + "/"
+        dirs[:] = sorted(d for d in dirs if d != ".git" and not
+                         (prune and is_dockerignored(rules, prefix + d)))
+        for name in sorted(files):
+            if is_dockerignored(rules, prefix + name):
+                continue
+            path = os.path.join(root, name)
+            digest.update((prefix + name).encode("utf-8") + b"\0")
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+async def run_docker_cli(args, stdin_data=None, env=None, echo=False):
+    proc = await asyncio.create_subprocess_exec("docker", *args,
+                                                stdin=asyncio.subprocess.PIPE
+                                                if stdin_data is not None else asyncio.subprocess.DEVNULL,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.STDOUT,
+                                                env=env)
+    if stdin_data is not None:
+        proc.stdin.write(stdin_data.encode("utf-8"))
+        proc.stdin.close()
+    async for line in read_lines(proc.stdout):
+        if echo:
+            logger.print(line.decode("utf-8", errors="replace").rstrip())
+            await logger.drain()
+    return await proc.wait()
+
+
+def image_repository(name):
+    """Repository part of image reference: without tag and digest. A ':'
+    before the last '/' is a registry port, not a tag."""
+    name = name.split("@")[0]
+    prefix, slash, last = name.rpartition("/")
+    if ":" in last:
+        last = last.rpartition(":")[0]
+    return prefix + slash + last
+
+
+async def make_docker_image(content, name, context=".", cache_from=None, buildkit=False):
+    """Build image from Dockerfile content unless an image built from the
+    same Dockerfile and context exists locally. Built images are also
+    tagged with the content hash, which is used for the check."""
+    # the context may be large, do not block prefetch running concurrently
+    context_hash = await asyncio.to_thread(hash_build_context, content, context)
+    content_tag = f"{image_repository(name)}:bonesinger-{context_hash[:16]}"
+    if await run_docker_cli(["image", "inspect", content_tag]) == 0:
+        logger.print(f"Docker image '{name}' is up to date: {content_tag}")
+        returncode = await run_docker_cli(["tag", content_tag, name], echo=True)
+        if returncode != 0:
+            raise Exception(f"Docker tag {content_tag} {name} failed with exit code {returncode}")
+        return
+
+    logger.print(f"Build docker image '{name}' ({content_tag})")
+    args = ["build", "-t", name, "-t", content_tag, "-f", "-"]
+    for image in cache_from or []:
+        args += ["--cache-from", image]
+    env = None
+    if buildkit:
+        env = dict(os.environ, DOCKER_BUILDKIT="1")
+        # make built image usable as cache_from source of later builds
+        args += ["--build-arg", "BUILDKIT_INLINE_CACHE=1"]
+    args.append(context)
+
+    returncode = await run_docker_cli(args, stdin_data=content, env=env, echo=True)
+    if returncode != 0:
+        raise Exception(f"Docker image build failed with exit code {returncode}")
@@ -0,0 +1,369 @@
+import asyncio
+import http.client
+import io
+import json
+import os
+import shlex
+import socket
+import struct
+import tarfile
+import threading
+import time
+import urllib.parse
+from .log import Logger
+
+logger = Logger.instance()
+
+DEFAULT_SOCKET_PATH = "/var/run/docker.sock"
+API_VERSION = "v1.41"
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Docker API error {status}: {message}")
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def demux_frames(data):
+    """Split multiplexed stdout/stderr stream of non-tty exec into
+    (stream, payload) pairs. Return them and the unparsed tail."""
+    frames = []
+    while len(data) >= 8:
+        stream, size = struct.unpack(">BxxxL", data[:8])
+        if len(data) < 8 + size:
+            break
+        frames.append((stream, data[8:8 + size]))
+        data = data[8 + size:]
+    return frames, data
+
+
+def parse_run_options(options):
+    """Convert subset of 'docker run' options to container create fields
+    (config, host_config)."""
+    config = {}
+    host_config = {}
+    args = shlex.split(options)
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        name, value = arg, None
+        if arg.startswith("--") and "=" in arg:
+            name, value = arg.split("=", 1)
+
+        def take_value():
+            nonlocal index
+            if value is not None:
+                return value
+            index += 1
+            if index >= len(args):
+                raise Exception(f"Docker option {name} requires value")
+            return args[index]
+
+        if name in ("-v", "--volume"):
+            host_config.setdefault("Binds", []).append(take_value())
+        elif name in ("-e", "--env"):
+            config.setdefault("Env", []).append(take_value())
+        elif name in ("-u", "--user"):
+            config["User"] = take_value()
+        elif name in ("-w", "--workdir"):
+            config["WorkingDir"] = take_value()
+        elif name in ("--network", "--net"):
+            host_config["NetworkMode"] = take_value()
+        elif name in ("-l", "--label"):
+            label, _, label_value = take_value().partition("=")
+            config.setdefault("Labels", {})[label] = label_value
+        elif name == "--privileged":
+            host_config["Privileged"] = True
+        else:
+            raise Exception(f"Docker option is not supported with API client: {arg}")
+        index += 1
+    return config, host_config
+
+
+class DockerClient:
+    """Minimal Docker Engine API client over Unix socket.
+    Synchronous requests share one persistent keep-alive connection;
+    exec output is read from a dedicated connection, because the engine
+    hijacks it for the raw stream."""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, api_version=API_VERSION):
+        self.socket_path = socket_path
+        self.api_version = api_version
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def url(self, path, query=None):
+        url = f"/{self.api_version}{path}"
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        return url
+
+    def request(self, method, path, body=None, query=None, raw=False):
+        """Send request over the persistent connection and return decoded
+        JSON (or raw bytes) of the response body."""
+        headers = {"Host": "docker"}
+        if body is not None and not raw:
+            body = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        elif body is not None:
+            headers["Content-Type"] = "application/x-tar"
+
+        with self.lock:
+            for attempt in range(2):
+                if self.connection is None:
+                    self.connection = UnixHTTPConnection(self.socket_path)
+                try:
+                    self.connection.request(method, self.url(path, query), body=body, headers=headers)
+                    response = self.connection.getresponse()
+                    data = response.read()
+                    break
+                except (http.client.HTTPException, ConnectionError, BrokenPipeError):
+                    # the engine may have closed idle keep-alive connection
+                    self.connection.close()
+                    self.connection = None
+                    if attempt == 1:
+                        raise
+
+        if response.status >= 400:
+            raise DockerAPIError(response.status, self.error_message(data))
+        if not data:
+            return None
+        if response.getheader("Content-Type", "").startswith("application/json"):
+            return json.loads(data)
+        return data
+
+    @staticmethod
+    def error_message(data):
+        try:
+            return json.loads(data)["message"]
+        except (ValueError, KeyError, TypeError):
+            return data.decode("utf-8", errors="replace")
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def pull_image(self, image):
+        name, _, tag = image.partition(":")
+        logger.print(f"Pull docker image {image}")
+        # progress stream is read to the end, the pull is finished then
+        self.request("POST", "/images/create", query={"fromImage": name, "tag": tag or "latest"})
+
+    def create_container(self, image, cmd, name, config=None, host_config=None):
+        body = {"Image": image, "Cmd": cmd, "Tty": True, "OpenStdin": True,
+                **(config or {}), "HostConfig": host_config or {}}
+        try:
+            result = self.request("POST", "/containers/create", body=body, query={"name": name})
+        except DockerAPIError as e:
+            if e.status != 404:
+                raise
+            self.pull_image(image)
+            result = self.request("POST", "/containers/create", body=body, query={"name": name})
+        return result["Id"]
+
+    def inspect_container(self, container):
+        return self.request("GET", f"/containers/{container}/json")
+
+    def start_container(self, container):
+        self.request("POST", f"/containers/{container}/start")
+
+    def stop_container(self, container):
+        self.request("POST", f"/containers/{container}/stop")
+
+    def remove_container(self, container):
+        self.request("DELETE", f"/containers/{container}", query={"force": "true"})
+
+    def put_archive(self, container, path, data):
+        self.request("PUT", f"/containers/{container}/archive", body=data, query={"path": path}, raw=True)
+
+    def upload_data(self, container, data, dest_path):
+        """Write bytes to file dest_path in container."""
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            info = tarfile.TarInfo(os.path.basename(dest_path))
+            info.size = len(data)
+            info.mtime = int(time.time())
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+        self.put_archive(container, os.path.dirname(dest_path) or "/", buffer.getvalue())
+
+    def upload_file(self, container, file_path, dest_path):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            tar.add(file_path, arcname=os.path.basename(dest_path))
+        self.put_archive(container, os.path.dirname(dest_path) or "/", buffer.getvalue())
+
+    def exec_body(self, cmd, workdir=None, stdin=False):
+        body = {"AttachStdout": True, "AttachStderr": True, "Cmd": cmd}
+        if stdin:
+            body["AttachStdin"] = True
+            body["OpenStdin"] = True
+        if workdir:
+            body["WorkingDir"] = workdir
+        return body
+
+    def exec_run(self, container, cmd, workdir=None):
+        """Run command in container and wait for it.
+        Return exit code and merged stdout/stderr output."""
+        exit_code, frames = self.exec_frames(container, cmd, workdir)
+        output = b"".join(payload for stream, payload in frames)
+        return exit_code, output.decode("utf-8", errors="replace")
+
+    def exec_output(self, container, cmd, workdir=None):
+        """Run command in container and wait for it.
+        Return exit code, stdout and stderr."""
+        exit_code, frames = self.exec_frames(container, cmd, workdir)
+        stdout = b"".join(payload for stream, payload in frames if stream != 2)
+        stderr = b"".join(payload for stream, payload in frames if stream == 2)
+        return (exit_code, stdout.decode("utf-8", errors="replace"),
+                stderr.decode("utf-8", errors="replace"))
+
+    def exec_frames(self, container, cmd, workdir=None):
+        exec_id = self.request("POST", f"/containers/{container}/exec",
+                               body=self.exec_body(cmd, workdir))["Id"]
+        connection = UnixHTTPConnection(self.socket_path)
+        try:
+            connection.request("POST", self.url(f"/exec/{exec_id}/start"),
+                               body=json.dumps({"Detach": False, "Tty": False}),
+                               headers={"Host": "docker", "Content-Type": "application/json"})
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise DockerAPIError(response.status, self.error_message(data))
+        frames, _ = demux_frames(data)
+        return self.request("GET", f"/exec/{exec_id}/json")["ExitCode"], frames
+
+    async def async_request(self, method, path, body=None):
+        """Request on a new asyncio connection, for use inside event loop."""
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        try:
+            await self.send_request(writer, method, path, body)
+            status, headers = await self.read_response_head(reader)
+            if headers.get("transfer-encoding") == "chunked":
+                data = await self.read_chunked(reader)
+            elif "content-length" in headers:
+                data = await reader.readexactly(int(headers["content-length"]))
+            else:
+                data = await reader.read()
+        finally:
+            writer.close()
+        if status >= 400:
+            raise DockerAPIError(status, self.error_message(data))
+        return json.loads(data) if data else None
+
+    async def send_request(self, writer, method, path, body):
+        payload = json.dumps(body).encode("utf-8") if body is not None else b""
+        head = (f"{method} {self.url(path)} HTTP/1.1\r\n"
+                "Host: docker\r\n"
+                "Connection: close\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(payload)}\r\n\r\n")
+        writer.write(head.encode("ascii") + payload)
+        await writer.drain()
+
+    @staticmethod
+    async def read_response_head(reader):
+        status_line = await reader.readline()
+        parts = status_line.decode("ascii", errors="replace").split(" ", 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise DockerAPIError(0, "Invalid response: " + status_line.decode("ascii", errors="replace"))
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        return int(parts[1]), headers
+
+    @staticmethod
+    async def read_chunked(reader):
+        data = b""
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                await reader.readline()
+                return data
+            data += await reader.readexactly(size)
+            await reader.readline()
+
+    async def exec_stream(self, container, cmd, workdir, on_line, stdin_data=None):
+        """Run command in container passing output lines to on_line
+        as soon as they arrive. Return exit code. stdin_data (bytes) is
+        written to stdin of the command over the hijacked connection,
+        which is half-closed then."""
+        stdin = stdin_data is not None
+        exec_id = (await self.async_request("POST", f"/containers/{container}/exec",
+                                            body=self.exec_body(cmd, workdir, stdin)))["Id"]
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+
+        async def feed():
+            # written concurrently with reading, the command may block
+            # on its output before it consumes the whole input
+            try:
+                writer.write(stdin_data)
+                await writer.drain()
+                writer.write_eof()
+            except ConnectionError:
+                pass
+
+        feeder = None
+        try:
+            await self.send_request(writer, "POST", f"/exec/{exec_id}/start",
+                                    {"Detach": False, "Tty": False})
+            status, _ = await self.read_response_head(reader)
+            if status >= 400:
+                raise DockerAPIError(status, self.error_message(await reader.read()))
+            if stdin:
+                feeder = asyncio.create_task(feed())
+
+            buffer = b""
+            line = b""
+            while True:
+                try:
+                    chunk = await reader.read(65536)
+                except ConnectionResetError:
+                    # the command exited without reading all of its stdin;
+                    # the output before it has been received already
+                    break
+                if not chunk:
+                    break
+                frames, buffer = demux_frames(buffer + chunk)
+                for _, payload in frames:
+                    lines = (line + payload).split(b"\n")
+                    line = lines.pop()
+                    for complete in lines:
+                        on_line(complete.decode("utf-8", errors="replace") + "\n")
+                await logger.drain()
+            if line:
+                on_line(line.decode("utf-8", errors="replace"))
+        finally:
+            if feeder is not None:
+                feeder.cancel()
+            writer.close()
+
+        return (await self.async_request("GET", f"/exec/{exec_id}/json"))["ExitCode"]
+
+
+def default_socket_path():
+    docker_host = os.environ.get("DOCKER_HOST", "")
+    if docker_host.startswith("unix://"):
+        return docker_host[len("unix://"):]
+    return DEFAULT_SOCKET_PATH
@@ -1,38 +1,75 @@
 from .docker import (
     start_docker_container,
     exec_in_docker_container,
+    run_in_docker_container,
     stop_docker_container,
-    upload_file_to_docker_container)
+    upload_file_to_docker_container,
+    docker_api_client)
 import abc
 import time
 import subprocess
-import fcntl
-import sys
+import shlex
 import os
-from .util import strong_key_format, generate_random_string
+import hashlib
+from .util import generate_random_string, read_lines
+from .session import ShellSession
+from .step_cache import glob_base, match_inputs, inputs_digest
+from .capture import FullCapture, TailCapture, NoCapture
+from .process import ChildProcess
+from .report import RunReport
+from .metrics import Metrics
+from .container_pool import ContainerPool
 from .log import Logger
 import asyncio
+import copy
 
 logger = Logger.instance()
 
 
+def git_output(args, returncode, stdout, stderr, check):
+    """Stdout of finished git command; raise with its stderr if it failed
+    and check is true."""
+    if returncode != 0 and check:
+        raise Exception(f"git {shlex.join(args)} failed with exit code {returncode}: "
+                        + stderr.strip())
+    return stdout.strip()
+
+
 class StepExecutor:
+    # run scripts of every pipeline in one long-lived shell instead of
+    # a process per step (see session.py)
+    session_mode = False
+    session = None
+
+    # "file": write script to temporary file and run it,
+    # "stdin": pipe script text to interpreter stdin
+    script_delivery = "file"
+
     @abc.abstractmethod
     def init_executor(self, script_executor):
         pass
 
     @abc.abstractmethod
     def run_script_cmd(self, file_path):
+        """Argument list of the command which runs script file."""
         pass
 
     @abc.abstractmethod
     def upload_temporary_file(self, path):
         pass
 
+    def run_stdin_script_cmd(self):
+        """Argument list of the command which runs script read from stdin."""
+        raise Exception(f"{type(self).__name__} does not support stdin script delivery")
+
     @abc.abstractmethod
     def finish_executor(self):
         pass
 
+    def local_directory(self):
+        """Directory of the host process in which script commands are started."""
+        return None
+
     @abc.abstractmethod
     def chdir(self, path):
         pass
@@ -41,177 +78,448 @@ class StepExecutor:
     def create_directory(self, path):
         pass
 
+    def checkout_cell_executor(self):
+        """Executor for one matrix value."""
+        return self.fork()
+
+    def release_cell_executor(self, executor):
+        pass
+
+    def fork(self):
+        """Executor sharing the environment of this one (e.g. docker container)
+        but with its own current directory."""
+        return copy.copy(self)
+
+    @abc.abstractmethod
+    def session_cmd(self):
+        """Argument list of the command which starts shell session."""
+        pass
+
+    async def start_session(self):
+        """Fork of this executor which runs its scripts in a new shell session."""
+        executor = self.fork()
+        executor.session = ShellSession(executor.session_cmd())
+        await executor.session.start()
+        return executor
+
+    async def close_session(self):
+        await self.session.close()
+        self.session = None
+
     def make_temporary_directory(self):
         random_name = generate_random_string(10)
         path = "/tmp/" + random_name
         self.create_directory(path)
         return path
 
+    # GitMirrorCache for clones, None to clone from remotes directly
+    git_cache = None
+
+    @abc.abstractmethod
+    def run_git(self, args, check=True):
+        """Run git with args where scripts are executed, return its stdout.
+        Raise if git fails, unless check is false."""
+        pass
+
+    def clone_repository(self, url, name, basepath, branch=None, commit=None,
+                         depth=None, filter_spec=None, sparse=None, submodules="recursive"):
+        """Clone url into basepath/name.
+        depth and filter_spec make shallow and partial clones, sparse limits
+        checkout to listed paths, commit is checked out detached after clone,
+        submodules is "recursive", "shallow" (depth 1) or "none"."""
+        path = f"{basepath}/{name}"
+        if self.git_cache is not None:
+            self.git_cache.checkout(url, path, branch, self.run_git,
+                                    commit=commit, sparse=sparse, submodules=submodules)
+        else:
+            args = ["clone", url, path]
+            if branch:
+                args += ["-b", branch]
+            if depth:
+                args += ["--depth", str(depth)]
+            if filter_spec:
+                args += ["--filter=" + filter_spec]
+            if sparse:
+                args += ["--sparse"]
+            logger.print("Clone output:", self.run_git(args))
+
+            if sparse:
+                self.run_git(["-C", path, "sparse-checkout", "set", "--"] + list(sparse))
+            if commit:
+                if depth:
+                    # the commit may be out of the shallow history
+                    self.run_git(["-C", path, "fetch", "--depth", str(depth), "origin", commit])
+                logger.print("Checkout output:",
+                             self.run_git(["-C", path, "checkout", "--detach", commit]))
+            if submodules != "none":
+                args = ["-C", path, "submodule", "update", "--init", "--recursive"]
+                if submodules == "shallow":
+                    args += ["--depth", "1"]
+                logger.print("Submodule output:", self.run_git(args))
+
+        # get commit hash to commit variable
+        commit = self.run_git(["-C", path, "rev-parse", "HEAD"])
+
+        # get message to message variable
+        message = self.run_git(["-C", path, "log", "-1", "--pretty=%B"])
+
+        # an extra git command (docker exec), only needed for metrics
+        size = self.repository_size(path) if Metrics.instance().enabled else None
+        return {"commit": commit, "message": message, "bytes": size}
+
+    def repository_size(self, path):
+        """Size of git objects of repository in bytes (objects borrowed
+        from a mirror are not counted), None if unknown."""
+        try:
+            output = self.run_git(["-C", path, "count-objects", "-v"])
+        except Exception:
+            return None
+        sizes = {}
+        for line in output.splitlines():
+            key, _, value = line.partition(":")
+            if value.strip().isdigit():
+                sizes[key.strip()] = int(value)
+        if "size" not in sizes:
+            return None
+        return (sizes.get("size", 0) + sizes.get("size-pack", 0)) * 1024
+
+    # StepCache for steps with 'cache:' record, None disables caching
+    step_cache = None
+
+    # CPU time and peak RSS of script processes describe the step; not so
+    # for docker exec, which only waits for the process in the container
+    measures_resources = True
+
     @abc.abstractmethod
-    def clone_repository(self, url, name, basepath, branch=None):
+    def environment_id(self):
+        """Text identifying where scripts run, part of step cache key."""
+        pass
+
+    @abc.abstractmethod
+    def hash_inputs(self, patterns):
+        """Hash of files matching glob patterns in current directory."""
         pass
 
     async def execute_script(self,
-                       script_lines,
+                       script,
                        pipeline_name,
                        script_name,
                        subst_dict,
                        prefix,
-                       debug):
+                       debug,
+                       cache=None,
+                       undefined="warn",
+                       capture=None):
+        """Render script and prefix templates with subst_dict and run them.
+        Output lines are appended to capture (if any), which the caller
+        reads and closes."""
         logger.print(
             f"###PIPELINE: {pipeline_name}, STEP: {script_name}, VARIABLES: {subst_dict}")
 
         if debug:
             logger.print("###DEBUG: " + str(prefix))
-            logger.print("###DEBUG: " + str(script_lines))
-
-        # gererate random name for temporary file
-        script_name_r = script_name.replace(" ", "_")
-        tmp_file = f"/tmp/{pipeline_name}_{script_name_r}_{time.time()}.tmp"
-
-        text = f"#!{self.script_executor}\n"
-        text += "set -ex\n"
-        text += strong_key_format(prefix, subst_dict)
+            logger.print("###DEBUG: " + str(script))
 
-        for line in script_lines:
-            line = strong_key_format(line, subst_dict)
-            text += line + "\n"
+        body = script.render(subst_dict, undefined)
+        if not body.endswith("\n"):
+            body += "\n"
+        text = "".join([f"#!{self.script_executor}\n",
+                        "set -ex\n",
+                        prefix.render(subst_dict, undefined),
+                        body])
 
         if debug:
             logger.print("Script:")
             logger.print(text)
 
-        with open(tmp_file, "w") as f:
-            f.write(text)
+        if capture is None:
+            capture = NoCapture()
+
+        cache_key = None
+        if cache is not None and self.step_cache is not None:
+            inputs_hash = await asyncio.to_thread(self.hash_inputs, cache["inputs"])
+            cache_key = self.step_cache.make_key(text, subst_dict, self.environment_id(), inputs_hash)
+            cached_output = self.step_cache.load(cache_key)
+            if cached_output is not None:
+                logger.print(f"Step cache hit: {cache_key}")
+                with cached_output:
+                    for line in cached_output:
+                        logger.print(line.rstrip(), stream="output")
+                        capture.append(line)
+                return
+
+        # step cache records whole output whatever the caller keeps
+        cache_capture = None
+        if cache_key is not None:
+            cache_capture = capture if isinstance(capture, FullCapture) else FullCapture()
+
+        def on_line(line):
+            logger.print(line.rstrip(), stream="output")
+            capture.append(line)
+            if cache_capture is not None and cache_capture is not capture:
+                cache_capture.append(line)
+
+        try:
+            if self.session is not None:
+                returncode = await self.session.run(text, self.current_directory, on_line)
+            else:
+                returncode = await self.run_script_process(text, pipeline_name, script_name, on_line)
+
+            # print exit code
+            logger.print(f"Exit code: {returncode}")
+            RunReport.set_arg("exit_code", returncode)
+
+            if returncode != 0:
+                message = f"{pipeline_name}:{script_name}: exit code: {returncode}"
+                if isinstance(capture, TailCapture) and capture.lines:
+                    message += "\n" + capture.getvalue().rstrip()
+                raise Exception(message)
+
+            if cache_capture is not None:
+                await asyncio.to_thread(self.step_cache.store, cache_key, cache_capture.iter_chunks(),
+                                        pipeline_name, script_name)
+        finally:
+            if cache_capture is not None and cache_capture is not capture:
+                cache_capture.close()
+
+    async def run_script_process(self, text, pipeline_name, script_name, on_line):
+        if self.script_delivery == "stdin":
+            cmd = self.run_stdin_script_cmd()
+        else:
+            # gererate random name for temporary file
+            script_name_r = script_name.replace(" ", "_")
+            tmp_file = f"/tmp/{pipeline_name}_{script_name_r}_{time.time()}.tmp"
 
-        self.upload_temporary_file(tmp_file)
+            with open(tmp_file, "w") as f:
+                f.write(text)
 
-        # run tmp/script.sh and listen stdout and stderr
-        proc = subprocess.Popen(self.run_script_cmd(tmp_file), shell=True,
-                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            self.upload_temporary_file(tmp_file)
+            cmd = self.run_script_cmd(tmp_file)
 
-        # set non-blocking output
-        fcntl.fcntl(proc.stdout, fcntl.F_SETFL, fcntl.fcntl(
-            proc.stdout, fcntl.F_GETFL) | os.O_NONBLOCK)
+        # run script and listen stdout and stderr
+        proc = await ChildProcess.start(cmd, cwd=self.local_directory(),
+                                        stdin=self.script_delivery == "stdin")
 
-        output = ""
-        while True:
-            # read stdout
+        async def feed():
+            # written concurrently with reading, the interpreter may block
+            # on its output before it consumes the whole script
             try:
-                line = proc.stdout.read()
-                if line:
-                    logger.print(line.decode("utf-8").strip())
-                    output += line.decode("utf-8")
-            except Exception as e:
-                print(e)
+                proc.stdin.write(text.encode("utf-8"))
+                await proc.stdin.drain()
+            except ConnectionError:
                 pass
-
-            sys.stdout.flush()
-
-            # check if process is finished
-            if proc.poll() is not None:
-                break
-
-            # sleep for 0.1 second
-            await asyncio.sleep(0.1)
-
-        # print exit code
-        logger.print(f"Exit code: {proc.returncode}")
-        if proc.returncode != 0:
-            raise Exception(f"{pipeline_name}:{script_name}: exit code: {proc.returncode}")
-
-        return output
+            finally:
+                proc.stdin.close()
+
+        feeder = asyncio.create_task(feed()) if self.script_delivery == "stdin" else None
+        try:
+            async for line in read_lines(proc.stdout):
+                on_line(line.decode("utf-8", errors="replace"))
+                await logger.drain()
+            await proc.wait()
+            if self.measures_resources:
+                RunReport.add_usage(proc.rusage)
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+        finally:
+            if feeder is not None:
+                feeder.cancel()
+
+        return proc.returncode
 
 
 class NativeExecutor(StepExecutor):
     def __init__(self, script_executor):
         self.init_executor(script_executor)
+        self.current_directory = None
 
     def init_executor(self, script_executor):
         self.script_executor = script_executor
 
     def run_script_cmd(self, file_path):
-        cmd = f"{self.script_executor} {file_path}"
-        return cmd
+        return shlex.split(self.script_executor) + [file_path]
 
     def upload_temporary_file(self, path):
         pass
 
+    def session_cmd(self):
+        return shlex.split(self.script_executor)
+
     def chdir(self, path):
-        os.chdir(path)
+        self.current_directory = path
+
+    def local_directory(self):
+        return self.current_directory
 
     def create_directory(self, path):
         os.mkdir(path)
 
-    def clone_repository(self, url, name, basepath, branch=None):
-        if branch:
-            cmd = f"git clone {url} {basepath}/{name} -b {branch} --recursive"
-        else:
-            cmd = f"git clone {url} {basepath}/{name} --recursive"
-        subprocess.run(cmd, shell=True)
-
-        # get commit hash to commit variable
-        proc = subprocess.Popen(["git", "rev-parse", "HEAD"], cwd=name, stdout=subprocess.PIPE)
-        commit = proc.stdout.read().decode("utf-8").strip()
-
-        # get message to message variable
-        proc = subprocess.Popen(["git", "log", "-1", "--pretty=%B"], cwd=name, stdout=subprocess.PIPE)
-        message = proc.stdout.read().decode("utf-8").strip()
-
-        return {"commit": commit, "message": message}
+    def run_git(self, args, check=True):
+        proc = subprocess.run(["git"] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return git_output(args, proc.returncode, proc.stdout.decode("utf-8", errors="replace"),
+                          proc.stderr.decode("utf-8", errors="replace"), check)
+
+    def environment_id(self):
+        return f"native {self.script_executor}"
+
+    def hash_inputs(self, patterns):
+        directory = self.current_directory or os.getcwd()
+        paths = set()
+        for base in {glob_base(pattern) for pattern in patterns}:
+            base_path = os.path.join(directory, base)
+            if os.path.isfile(base_path):
+                paths.add(os.path.normpath(base))
+            for root, _, files in os.walk(base_path):
+                for name in files:
+                    paths.add(os.path.relpath(os.path.join(root, name), directory))
+
+        file_hashes = []
+        for path in match_inputs(paths, patterns):
+            file_digest = hashlib.sha256()
+            with open(os.path.join(directory, path), "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    file_digest.update(chunk)
+            file_hashes.append((path, file_digest.hexdigest()))
+        return inputs_digest(file_hashes)
 
     def finish_executor(self):
         pass
 
 
 class DockerExecutor(StepExecutor):
-    def __init__(self, image, script_executor, addfiles=[], additional_options=""):
+    measures_resources = False
+
+    def __init__(self, image, script_executor, addfiles=[], additional_options="",
+                 script_delivery="file", pool_options=None):
         self.image = image
+        self.script_delivery = script_delivery
         self.container_name = None
         self.docker_additional_options = additional_options
+        self.addfiles = addfiles
+        self.created_directories = []
+        self.pool = None
+        if pool_options is not None:
+            self.pool = ContainerPool(image, script_executor, additional_options, **pool_options)
         self.init_executor(script_executor, addfiles)
         self.current_directory = None
 
     def init_executor(self, script_executor, addfiles):
         self.script_executor = script_executor
-        self.container_name = start_docker_container(self.image, script_executor, 
-                                                     self.docker_additional_options)
-
-        for addfile in addfiles:
-            upload_file_to_docker_container(self.container_name, addfile["src"], addfile["dst"])
+        # with a pool every matrix value checks out its own container,
+        # this executor only makes them
+        if self.pool is None:
+            self.container_name = self.checkout_container()
+
+    def checkout_container(self):
+        if Metrics.instance().enabled:
+            Metrics.instance().add("bonesinger_containers_live", 1)
+        if self.pool is not None:
+            container_name = self.pool.checkout()
+        else:
+            container_name = start_docker_container(self.image, self.script_executor,
+                                                    self.docker_additional_options)
+
+        for addfile in self.addfiles:
+            upload_file_to_docker_container(container_name, addfile["src"], addfile["dst"])
+        return container_name
+
+    def checkout_cell_executor(self):
+        if self.pool is None:
+            return self.fork()
+        executor = self.fork()
+        executor.created_directories = []
+        executor.container_name = self.checkout_container()
+        return executor
+
+    def release_cell_executor(self, executor):
+        if self.pool is not None:
+            self.pool.checkin(executor.container_name, executor.created_directories)
+            if Metrics.instance().enabled:
+                Metrics.instance().add("bonesinger_containers_live", -1)
 
     def run_script_cmd(self, file_path):
+        cmd = ["docker", "exec"]
         if self.current_directory:
-            cmd = f"docker exec -w {self.current_directory} {self.container_name} {self.script_executor} {file_path}"
-        else:
-            cmd = f"docker exec {self.container_name} {self.script_executor} {file_path}"
-        return cmd
+            cmd += ["-w", self.current_directory]
+        return cmd + [self.container_name] + shlex.split(self.script_executor) + [file_path]
+
+    async def run_script_process(self, text, pipeline_name, script_name, on_line):
+        client = docker_api_client()
+        if client is None:
+            return await super().run_script_process(text, pipeline_name, script_name, on_line)
+
+        if self.script_delivery == "stdin":
+            return await client.exec_stream(self.container_name, shlex.split(self.script_executor),
+                                            self.current_directory, on_line,
+                                            stdin_data=text.encode("utf-8"))
+
+        script_name_r = script_name.replace(" ", "_")
+        tmp_file = f"/tmp/{pipeline_name}_{script_name_r}_{time.time()}.tmp"
+        # the script goes to the container without a file on the host
+        await asyncio.to_thread(client.upload_data, self.container_name, text.encode("utf-8"), tmp_file)
+        cmd = shlex.split(self.script_executor) + [tmp_file]
+        return await client.exec_stream(self.container_name, cmd, self.current_directory, on_line)
+
+    def run_stdin_script_cmd(self):
+        cmd = ["docker", "exec", "-i"]
+        if self.current_directory:
+            cmd += ["-w", self.current_directory]
+        return cmd + [self.container_name] + shlex.split(self.script_executor)
 
     def upload_temporary_file(self, path):
         upload_file_to_docker_container(self.container_name, path, path)
 
+    def session_cmd(self):
+        return ["docker", "exec", "-i", self.container_name] + shlex.split(self.script_executor)
+
     def chdir(self, path):
         self.current_directory = path
 
     def create_directory(self, path):
         logger.print("DockerExecutor.create_directory: " + path)
         exec_in_docker_container(self.container_name, f"mkdir -p {path}")
-
-    def clone_repository(self, url, name, basepath, branch=None):
-        if branch:
-            cmd = f"git clone {url} {basepath}/{name} -b {branch} --recursive"
-        else:
-            cmd = f"git clone {url} {basepath}/{name} --recursive"
-        out = exec_in_docker_container(self.container_name, cmd)
-        logger.print("Clone output:", out)
-
-        # get commit hash to commit variable
-        commit = exec_in_docker_container(self.container_name, f"git -C {basepath}/{name} rev-parse HEAD")
-
-        # get message to message variable
-        message = exec_in_docker_container(self.container_name, f"git -C {basepath}/{name} log -1 --pretty=%B")
-
-        return {"commit": commit, "message": message}
+        self.created_directories.append(path)
+
+    def run_git(self, args, check=True):
+        returncode, stdout, stderr = run_in_docker_container(self.container_name, ["git"] + args)
+        return git_output(args, returncode, stdout, stderr, check)
+
+    def environment_id(self):
+        return f"docker {self.image} {self.script_executor}"
+
+    def hash_inputs(self, patterns):
+        if not patterns:
+            return inputs_digest([])
+        # files are listed and hashed in the container, selected here
+        cd = f"cd {shlex.quote(self.current_directory or '/')} && "
+        bases = sorted({glob_base(pattern) for pattern in patterns})
+        _, output, _ = run_in_docker_container(
+            self.container_name,
+            ["sh", "-c", cd + 'find "$@" -type f -print0', "sh"] + bases)
+        paths = {path[2:] if path.startswith("./") else path
+                 for path in output.split("\0") if path}
+        matched = match_inputs(paths, patterns)
+        if not matched:
+            return inputs_digest([])
+
+        returncode, output, stderr = run_in_docker_container(
+            self.container_name,
+            ["sh", "-c", cd + 'sha256sum -- "$@"', "sh"] + matched)
+        if returncode != 0:
+            raise Exception("Hashing step inputs failed: " + stderr.strip())
+        file_hashes = []
+        for line in output.splitlines():
+            file_hash, _, path = line.partition("  ")
+            file_hashes.append((path, file_hash))
+        return inputs_digest(file_hashes)
 
     def finish_executor(self):
+        if self.pool is not None:
+            # containers of matrix values are back in the pool already
+            self.pool.finish()
+            return
         stop_docker_container(self.container_name)
+        if Metrics.instance().enabled:
+            Metrics.instance().add("bonesinger_containers_live", -1)
@@ -0,0 +1,132 @@
+import fcntl
+import hashlib
+import os
+import re
+import subprocess
+import threading
+import urllib.parse
+from .log import Logger
+
+logger = Logger.instance()
+
+
+def resolve_submodule_url(base_url, url):
+    """Resolve relative submodule url (../name) against superproject url."""
+    if not url.startswith("./") and not url.startswith("../"):
+        return url
+    return urllib.parse.urljoin(base_url.rstrip("/") + "/", url)
+
+
+class GitMirrorCache:
+    """Persistent bare mirrors of remote repositories (and of their
+    submodules) on the host, keyed by url. A mirror is fetched once per
+    bonesinger run; workspaces are cloned from it with --shared, so a
+    checkout transfers nothing over the network.
+
+    Mirror updates take an exclusive flock, checkouts a shared one, so
+    concurrent runs may use the same cache. Automatic gc is disabled in
+    mirrors because workspaces borrow their objects."""
+
+    _default_directory = os.path.expanduser("~/.bonesinger-git/")
+
+    def __init__(self, directory=None):
+        self.directory = os.path.expanduser(directory or GitMirrorCache._default_directory)
+        self.updated = set()
+        # per-url locks held for the whole mirror update
+        self.url_locks = {}
+        self.updated_lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def mirror_path(self, url):
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+        name = re.sub(r"[^\w.-]", "_", url.rstrip("/").split("/")[-1])
+        return os.path.join(self.directory, f"{name}-{digest}.git")
+
+    def lock(self, url, mode):
+        lock = open(self.mirror_path(url) + ".lock", "w")
+        fcntl.flock(lock, mode)
+        return lock
+
+    def update_mirror(self, url):
+        """Create or fetch mirror of url, at most once per run. Concurrent
+        callers for the same url wait until the update is finished."""
+        with self.updated_lock:
+            url_lock = self.url_locks.setdefault(url, threading.Lock())
+
+        path = self.mirror_path(url)
+        with url_lock:
+            if url in self.updated:
+                return path
+            with self.lock(url, fcntl.LOCK_EX):
+                if os.path.exists(path):
+                    logger.print(f"Fetch mirror: {url}")
+                    cmd = ["git", "-C", path, "fetch", "--prune", "origin"]
+                else:
+                    logger.print(f"Create mirror: {url}")
+                    cmd = ["git", "clone", "--mirror", url, path]
+                proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                if proc.returncode != 0:
+                    raise Exception(f"Mirror update failed for {url}: " + proc.stdout.decode("utf-8"))
+                subprocess.run(["git", "-C", path, "config", "gc.auto", "0"], check=True)
+            self.updated.add(url)
+        return path
+
+    def prefetch(self, url, branch=None):
+        """Update mirror of url and, recursively, mirrors of submodules
+        listed in .gitmodules of branch (default branch if None)."""
+        mirror = self.update_mirror(url)
+        proc = subprocess.run(["git", "-C", mirror, "config", "--blob", f"{branch or 'HEAD'}:.gitmodules",
+                               "--get-regexp", r"^submodule\..*\.url$"],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        for line in proc.stdout.decode("utf-8").splitlines():
+            match = re.match(r"^submodule\.(.+)\.url (.+)$", line)
+            if match is not None:
+                self.prefetch(resolve_submodule_url(url, match.group(2)))
+
+    def checkout(self, url, path, branch, run_git, commit=None, sparse=None, submodules="recursive"):
+        """Clone url into path from its mirror and check out submodules
+        the same way. run_git(args, check=True) runs git where the
+        workspace lives (host or container) and returns its stdout, raising
+        if git fails unless check is false; the cache directory
+        must be visible there under the same path. Depth and filter are
+        not needed for a local clone; submodules "shallow" is the same as
+        "recursive" here."""
+        mirror = self.update_mirror(url)
+        args = ["clone", "--shared", mirror, path]
+        if branch:
+            args += ["-b", branch]
+        if sparse:
+            args += ["--sparse"]
+        with self.lock(url, fcntl.LOCK_SH):
+            logger.print("Clone output:", run_git(args))
+            if sparse:
+                run_git(["-C", path, "sparse-checkout", "set", "--"] + list(sparse))
+            if commit:
+                logger.print("Checkout output:", run_git(["-C", path, "checkout", "--detach", commit]))
+        run_git(["-C", path, "remote", "set-url", "origin", url])
+        if submodules != "none":
+            self.checkout_submodules(url, path, run_git)
+
+    def checkout_submodules(self, url, path, run_git):
+        # exit code 1 without .gitmodules or submodules in it
+        output = run_git(["-C", path, "config", "-f", ".gitmodules",
+                          "--get-regexp", r"^submodule\..*\.url$"], check=False)
+        for line in output.splitlines():
+            match = re.match(r"^submodule\.(.+)\.url (.+)$", line)
+            if match is None:
+                continue
+            name, submodule_url = match.group(1), resolve_submodule_url(url, match.group(2))
+            subpath = run_git(["-C", path, "config", "-f", ".gitmodules",
+                               f"submodule.{name}.path"])
+            mirror = self.update_mirror(submodule_url)
+
+            # point submodule to the mirror for update, then restore its url
+            run_git(["-C", path, "config", f"submodule.{name}.url", mirror])
+            with self.lock(submodule_url, fcntl.LOCK_SH):
+                logger.print("Submodule output:", run_git(
+                    ["-C", path, "-c", "protocol.file.allow=always",
+                     "submodule", "update", "--init", "--", subpath]))
+            run_git(["-C", path, "config", f"submodule.{name}.url", submodule_url])
+            run_git(["-C", os.path.join(path, subpath), "remote", "set-url", "origin", submodule_url])
+
+            self.checkout_submodules(submodule_url, os.path.join(path, subpath), run_git)
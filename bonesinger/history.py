@@ -0,0 +1,179 @@
+import json
+import math
+import os
+import sqlite3
+import statistics
+import time
+from .log import Logger
+
+logger = Logger.instance()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id TEXT PRIMARY KEY,
+    started REAL,
+    duration REAL,
+    scripts TEXT,
+    entrance TEXT,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS cells (
+    run_id TEXT,
+    matrix TEXT,
+    started REAL,
+    duration REAL,
+    status TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS pipelines (
+    run_id TEXT,
+    matrix TEXT,
+    pipeline TEXT,
+    started REAL,
+    duration REAL,
+    status TEXT,
+    commit_hash TEXT,
+    clone_duration REAL
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run_id TEXT,
+    matrix TEXT,
+    pipeline TEXT,
+    step TEXT,
+    started REAL,
+    duration REAL,
+    status TEXT,
+    exit_code INTEGER,
+    utime REAL,
+    stime REAL,
+    max_rss_kb INTEGER
+);
+CREATE INDEX IF NOT EXISTS steps_by_name ON steps (pipeline, step, started);
+"""
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, math.ceil(fraction * len(values)) - 1))
+    return values[index]
+
+
+class RunHistory:
+    """Runs, matrix cells, pipelines and steps of past runs with their
+    durations, statuses, exit codes and commits, in a SQLite database."""
+
+    _default_path = os.path.expanduser("~/.bonesinger-cache/history.sqlite")
+
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path or RunHistory._default_path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=30)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def record_run(self, report, results, scripts, entrance):
+        """Store spans of RunReport and per-cell results of Core."""
+        data = report.to_dict()
+        spans = data["spans"]
+        run_id = data["run"] or str(int(data["start"]))
+        status = "success" if all(result["status"] == "success" for result in results) else "failed"
+
+        def matrix_text(value):
+            return json.dumps(value, sort_keys=True, default=str)
+
+        clones = {span["parent"]: span for span in spans if span["category"] == "clone"}
+        cell_starts = {matrix_text(span["matrix"]): span["start"]
+                       for span in spans if span["category"] == "cell"}
+
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)",
+                (run_id, data["start"], data["duration"], json.dumps(scripts), entrance, status))
+            self.connection.executemany(
+                "INSERT INTO cells VALUES (?, ?, ?, ?, ?, ?)",
+                [(run_id, matrix_text(result["matrix_value"]),
+                  cell_starts.get(matrix_text(result["matrix_value"])),
+                  result["duration"], result["status"], result["error"])
+                 for result in results])
+            self.connection.executemany(
+                "INSERT INTO pipelines VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, matrix_text(span["matrix"]), span["name"], span["start"],
+                  span["duration"], span["status"],
+                  clones[span["id"]]["args"].get("commit") if span["id"] in clones else None,
+                  clones[span["id"]]["duration"] if span["id"] in clones else None)
+                 for span in spans if span["category"] == "pipeline"])
+            self.connection.executemany(
+                "INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, matrix_text(span["matrix"]), span["pipeline"], span["name"],
+                  span["start"], span["duration"], span["status"],
+                  span["args"].get("exit_code"), span["args"].get("utime"),
+                  span["args"].get("stime"), span["args"].get("max_rss_kb"))
+                 for span in spans if span["category"] == "step"])
+
+    def step_runs(self, pipeline=None, step=None, since=None):
+        """Successful step executions, oldest first:
+        (run_id, matrix, pipeline, step, started, duration)."""
+        query = ("SELECT run_id, matrix, pipeline, step, started, duration FROM steps "
+                 "WHERE status = 'success'")
+        params = []
+        if pipeline:
+            query += " AND pipeline = ?"
+            params.append(pipeline)
+        if step:
+            query += " AND step = ?"
+            params.append(step)
+        if since is not None:
+            query += " AND started >= ?"
+            params.append(since)
+        return self.connection.execute(query + " ORDER BY started", params).fetchall()
+
+
+def print_stats(history, pipeline=None, step=None, days=30, top=20, baseline=10, threshold=1.5,
+                min_increase=1.0):
+    """Print p50/p95 durations of steps, the slowest steps and the runs
+    where a step took threshold times (and at least min_increase seconds)
+    longer than the median of its previous baseline runs with the same
+    pipeline, step and matrix value."""
+    rows = history.step_runs(pipeline, step, since=time.time() - days * 24 * 3600)
+    if not rows:
+        print("No step runs in history")
+        return
+
+    by_step = {}
+    for run_id, matrix, pipeline_name, step_name, started, duration in rows:
+        by_step.setdefault((pipeline_name, step_name), []).append(duration)
+
+    table = []
+    for (pipeline_name, step_name), durations in by_step.items():
+        durations = sorted(durations)
+        table.append((percentile(durations, 0.95), percentile(durations, 0.5),
+                      len(durations), pipeline_name, step_name))
+    table.sort(reverse=True)
+
+    print(f"Slowest steps in last {days} days (by p95):")
+    print(f"  {'p50':>9} {'p95':>9} {'runs':>5}  pipeline:step")
+    for p95, p50, count, pipeline_name, step_name in table[:top]:
+        print(f"  {p50:8.1f}s {p95:8.1f}s {count:5}  {pipeline_name}:{step_name}")
+
+    regressions = []
+    previous = {}
+    for run_id, matrix, pipeline_name, step_name, started, duration in rows:
+        durations = previous.setdefault((pipeline_name, step_name, matrix), [])
+        if len(durations) >= min(3, baseline):
+            median = statistics.median(durations[-baseline:])
+            if median > 0 and duration > threshold * median and duration - median >= min_increase:
+                regressions.append((started, run_id, pipeline_name, step_name, matrix,
+                                    duration, median))
+        durations.append(duration)
+
+    print(f"Regressions (over {threshold}x median of previous {baseline} runs):")
+    if not regressions:
+        print("  none")
+    for started, run_id, pipeline_name, step_name, matrix, duration, median in regressions[-top:]:
+        date = time.strftime("%Y-%m-%d %H:%M", time.localtime(started))
+        print(f"  {date} {run_id} {pipeline_name}:{step_name} {matrix}: "
+              f"{duration:.1f}s, median {median:.1f}s (x{duration / median:.1f})")
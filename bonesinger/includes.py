@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import json
+import os
+from .log import Logger
+
+logger = Logger.instance()
+
+
+class HttpCache:
+    """On-disk copies of included http(s) scripts. Copies are revalidated
+    with ETag / If-Modified-Since; in offline mode they are used as is."""
+
+    _default_directory = os.path.expanduser("~/.bonesinger-cache/http/")
+
+    def __init__(self, directory=None, offline=False):
+        self.directory = os.path.expanduser(directory or HttpCache._default_directory)
+        self.offline = offline
+        os.makedirs(self.directory, exist_ok=True)
+
+    def entry_path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def load(self, url):
+        try:
+            with open(self.entry_path(url), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, url, content, etag, last_modified):
+        path = self.entry_path(url)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"url": url, "etag": etag, "last_modified": last_modified,
+                       "content": content}, f)
+        os.replace(tmp_path, path)
+
+    def get(self, url):
+        entry = self.load(url)
+        if self.offline:
+            if entry is None:
+                raise Exception("Offline mode: no cached copy of " + url)
+            return entry["content"]
+
+        import requests
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            r = requests.get(url, headers=headers, timeout=30)
+        except requests.RequestException as e:
+            if entry is None:
+                raise
+            logger.print(f"Download of {url} failed ({e}), use cached copy")
+            return entry["content"]
+
+        if r.status_code == 304 and entry is not None:
+            return entry["content"]
+        r.raise_for_status()
+        self.store(url, r.text, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+        return r.text
+
+
+class IncludeResolver:
+    """Resolves scripts and their 'include:' / '#!include' sources.
+    Every source is fetched once, and all includes of a source are
+    fetched concurrently as soon as it is parsed. The merge order is the
+    same as of sequential resolution: 'include:' entries, the source
+    itself, then '#!include' lines; a source included several times is
+    merged at its first position only. Include cycles are errors."""
+
+    def __init__(self, parse, http_cache=None):
+        # parse(content) -> (content hash, {"dict": ..., "line_includes": [...]})
+        self.parse = parse
+        self.http_cache = http_cache if http_cache is not None else HttpCache()
+        self.loads = {}
+
+    def get_content(self, url):
+        if url.startswith("http"):
+            return self.http_cache.get(url)
+        with open(url, "r") as stream:
+            return stream.read()
+
+    async def load_source(self, url):
+        content = await asyncio.to_thread(self.get_content, url)
+        return self.parse(content)
+
+    def load(self, url):
+        if url not in self.loads:
+            self.loads[url] = asyncio.ensure_future(self.load_source(url))
+        return self.loads[url]
+
+    @staticmethod
+    def includes_of(parsed):
+        dct = parsed["dict"]
+        includes = list(dct.get("include", [])) if dct is not None else []
+        return includes, parsed["line_includes"]
+
+    async def resolve(self, pathes):
+        """Return dictionaries in merge order and (url, content hash)
+        of sources in the same order."""
+        dicts = []
+        sources = []
+        visited = set()
+
+        async def visit(url, stack):
+            if url in stack:
+                raise Exception("Include cycle: " + " -> ".join(stack + [url]))
+            if url in visited:
+                return
+            visited.add(url)
+
+            key, parsed = await self.load(url)
+            includes, line_includes = self.includes_of(parsed)
+            for include in includes + line_includes:
+                self.load(include)
+
+            for include in includes:
+                await visit(include, stack + [url])
+            if parsed["dict"] is not None:
+                dicts.append(parsed["dict"])
+            sources.append((url, key))
+            for include in line_includes:
+                logger.print("Include:", include)
+                await visit(include, stack + [url])
+
+        try:
+            for path in pathes:
+                self.load(path)
+            for path in pathes:
+                await visit(path, [])
+        finally:
+            for task in self.loads.values():
+                if not task.done():
+                    task.cancel()
+            # retrieve exceptions of loads which are not awaited
+            await asyncio.gather(*self.loads.values(), return_exceptions=True)
+        return dicts, sources
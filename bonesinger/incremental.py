@@ -0,0 +1,80 @@
+import fcntl
+import json
+import os
+import subprocess
+import threading
+import time
+from .log import Logger
+
+logger = Logger.instance()
+
+
+def remote_head(url, branch):
+    """Commit hash of branch on remote, None if it can not be resolved."""
+    ref = f"refs/heads/{branch}" if branch else "HEAD"
+    proc = subprocess.run(["git", "ls-remote", url, ref],
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    for line in proc.stdout.decode("utf-8").splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1] == ref:
+            return parts[0]
+    return None
+
+
+class IncrementalState:
+    """Last successful commit of every git pipeline per matrix value,
+    persisted between runs. A pipeline is up to date when remote head,
+    pipeline configuration and matrix value match the record."""
+
+    _default_path = os.path.expanduser("~/.bonesinger-cache/incremental.json")
+
+    def __init__(self, path=None, force=False):
+        self.path = os.path.expanduser(path or IncrementalState._default_path)
+        self.force = force
+        self.lock = threading.Lock()
+        self.skipped = []
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    @staticmethod
+    def make_key(pipeline_name, matrix_value):
+        return pipeline_name + " " + json.dumps(matrix_value, sort_keys=True, default=str)
+
+    def read(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def lookup(self, pipeline_name, matrix_value, commit, config_hash):
+        """Return record of previous successful run if it is still valid."""
+        if self.force:
+            return None
+        record = self.read().get(self.make_key(pipeline_name, matrix_value))
+        if record is None or record["commit"] != commit or record["config"] != config_hash:
+            return None
+        return record
+
+    def record_success(self, pipeline_name, matrix_value, commit, message, config_hash, success_info):
+        key = self.make_key(pipeline_name, matrix_value)
+        with self.lock, open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self.read()
+            state[key] = {"commit": commit, "message": message, "config": config_hash,
+                          "success_info": success_info, "time": time.time()}
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(state, f, indent=1)
+            os.replace(tmp_path, self.path)
+
+    def mark_skipped(self, pipeline_name, matrix_value, commit):
+        with self.lock:
+            self.skipped.append({"pipeline": pipeline_name, "matrix_value": matrix_value,
+                                 "commit": commit})
+
+    def report(self):
+        if not self.skipped:
+            return
+        logger.print("Skipped pipelines (commit unchanged):")
+        for entry in self.skipped:
+            logger.print(f"  {entry['pipeline']} {entry['commit'][:12]}  {entry['matrix_value']}")
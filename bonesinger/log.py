@@ -1,26 +1,313 @@
+import asyncio
 import os
 import datetime
+import gzip
+import json
+import queue
+import shutil
+import sys
+import threading
 import time
+import atexit
+import collections
+import contextlib
+import contextvars
+import fcntl
+import uuid
+
+# pipeline / step / matrix value of the code which is logging;
+# asyncio tasks and threads started with to_thread inherit it
+log_context = contextvars.ContextVar("bonesinger_log_context", default={})
+
+
+def log_part_key(name):
+    """Sort key of log files: run name, then part number.
+    Parts of log-<date>.jsonl are log-<date>.1.jsonl, log-<date>.2.jsonl...,
+    compressed ones have .gz suffix."""
+    stem, _, rest = name.partition(".")
+    number = rest.split(".")[0]
+    return stem, int(number) if number.isdigit() else 0
+
+
+def context_key(context):
+    return (context.get("pipeline"), context.get("step"),
+            json.dumps(context.get("matrix"), sort_keys=True, default=str))
+
+
+class LogWriter(threading.Thread):
+    """Writes log records to console and logfile in a background thread.
+
+    All console output of a run goes through it, so lines of different
+    producers are not mixed. Records are taken from a queue and written
+    in batches. When the queue grows over high_water records (the
+    console or disk is slower than output), the writer is behind until
+    it halves the queue; readers of step output wait meanwhile (see
+    Logger.drain), so steps are blocked on their pipes. The queue holds
+    at most max_queue records: put() never blocks the event loop and
+    drops what does not fit there (the number is logged), other
+    threads wait for room. The file is
+    flushed every flush_interval seconds, also when the run is idle.
+    When a file grows over max_bytes, the next part of the log is
+    started and the full one is compressed; only max_files newest
+    log files are kept in the directory. The file being written is
+    flock-ed, so that other runs do not compress it.
+
+    The logfile holds one JSON record per line. The index file
+    (<log name>.idx) maps every pipeline / step / matrix value to the
+    byte ranges of its records in the parts and holds step statuses.
+
+    Listeners are called from the writer thread with every written
+    batch of records (as dicts); they must not block."""
+
+    _stop_marker = object()
+
+    def __init__(self, directory, logname, run_id, high_water=10000, max_queue=None,
+                 flush_interval=1.0, max_bytes=64 * 1024 * 1024, max_files=50, batch_size=1000):
+        super().__init__(name="bonesinger-log", daemon=True)
+        self.directory = directory
+        self.logname = logname
+        self.run_id = run_id
+        self.high_water = high_water
+        self.queue = queue.Queue(maxsize=max_queue or 4 * high_water)
+        # set when the queue is over high_water, until it is drained
+        self.behind = False
+        # the warning about it is logged once
+        self.warned = False
+        # records dropped in the event loop, and how many of them are reported
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.batch_size = batch_size
+        self.part = 0
+        self.written = 0
+        # [context key, context, start offset, end offset] of records being written
+        self.range = None
+        self.listeners = []
+        self.file = self.open_part(0)
+        self.index = open(self.index_path(directory, logname), 'w')
+
+    @staticmethod
+    def index_path(directory, logname):
+        return os.path.join(directory, logname.split(".")[0] + ".idx")
+
+    def open_part(self, part):
+        f = open(os.path.join(self.directory, self.part_name(part)), 'wb')
+        fcntl.flock(f, fcntl.LOCK_SH)
+        return f
+
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                # not the event loop thread, may wait
+                self.queue.put(record)
+                return
+            self.dropped += 1
+            return
+        if not self.behind and self.queue.qsize() > self.high_water:
+            self.behind = True
+            if self.warned:
+                return
+            self.warned = True
+            try:
+                self.queue.put_nowait((time.time(), {}, "log",
+                                       f"Warning: log writer is {self.queue.qsize()} records behind, "
+                                       "step output is held back"))
+            except queue.Full:
+                pass
+
+    def part_name(self, part):
+        if part == 0:
+            return self.logname
+        stem, ext = os.path.splitext(self.logname)
+        return f"{stem}.{part}{ext}"
+
+    def run(self):
+        threading.Thread(target=self.compress_old_logs, daemon=True).start()
+        lastflush = time.time()
+        stopped = False
+        while not stopped:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch and batch[-1] is LogWriter._stop_marker:
+                batch.pop()
+                stopped = True
+            synced = [item for item in batch if isinstance(item, threading.Event)]
+            if synced:
+                batch = [item for item in batch if not isinstance(item, threading.Event)]
+
+            dropped = self.dropped
+            if dropped != self.reported_dropped:
+                batch.append((time.time(), {}, "log",
+                              f"Warning: {dropped - self.reported_dropped} log records dropped, "
+                              "log writer queue is full"))
+                self.reported_dropped = dropped
+            if batch:
+                self.write(batch)
+            if self.behind and self.queue.qsize() < self.high_water // 2:
+                self.behind = False
+            for event in synced:
+                event.set()
+            if stopped or time.time() - lastflush >= self.flush_interval:
+                self.flush()
+                lastflush = time.time()
+        self.file.close()
+        self.index.close()
+
+    def write(self, batch):
+        console = []
+        lines = []
+        records = []
+        for timestamp, context, stream, text in batch:
+            if stream != "status":
+                console.append(text + "\n")
+
+            record = {"time": timestamp, "run": self.run_id, **context,
+                      "stream": stream, "line": text}
+            records.append(record)
+            line = json.dumps(record, default=str).encode("utf-8") + b"\n"
+            if stream == "status":
+                self.write_index({**context, "status": text})
+
+            if self.range is not None and self.range[1] is not context \
+                    and self.range[0] != context_key(context):
+                self.close_range()
+            if self.range is None:
+                self.range = [context_key(context), context, self.written, self.written]
+            self.range[3] += len(line)
+            self.written += len(line)
+            lines.append(line)
+
+        sys.stdout.write("".join(console))
+        self.file.write(b"".join(lines))
+        for listener in self.listeners:
+            listener(records)
+        if self.written > self.max_bytes:
+            self.rotate()
+
+    def write_index(self, entry):
+        self.index.write(json.dumps(entry, default=str) + "\n")
+
+    def close_range(self):
+        if self.range is None:
+            return
+        _, context, start, end = self.range
+        self.write_index({**context, "part": self.part_name(self.part), "start": start, "end": end})
+        self.range = None
+
+    def flush(self):
+        # ranges are closed on flush, so the index is usable during the run
+        self.close_range()
+        sys.stdout.flush()
+        self.file.flush()
+        self.index.flush()
+
+    def rotate(self):
+        self.close_range()
+        self.file.close()
+        try:
+            self.compress(os.path.join(self.directory, self.part_name(self.part)))
+        except OSError:
+            pass
+        self.part += 1
+        self.written = 0
+        self.file = self.open_part(self.part)
+        self.remove_old_logs()
+
+    @staticmethod
+    def compress(path):
+        with open(path, 'rb') as src:
+            try:
+                fcntl.flock(src, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # written by another run
+                return
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with gzip.open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(tmp_path, path + ".gz")
+            os.remove(path)
+
+    def compress_old_logs(self):
+        """Compress plain logs of previous runs."""
+        for name in os.listdir(self.directory):
+            if (name.startswith("log-") and name.endswith((".txt", ".jsonl"))
+                    and name != self.part_name(self.part)):
+                try:
+                    self.compress(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+        self.remove_old_logs()
+
+    def remove_old_logs(self):
+        names = os.listdir(self.directory)
+        parts = sorted((name for name in names
+                        if name.startswith("log-") and not name.endswith((".tmp", ".idx"))),
+                       key=log_part_key)
+        for name in parts[:max(0, len(parts) - self.max_files)]:
+            if name == self.part_name(self.part):
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+        # indexes of runs without any part left
+        runs = set(name.split(".")[0] for name in os.listdir(self.directory)
+                   if not name.endswith(".idx"))
+        for name in names:
+            if name.endswith(".idx") and name.split(".")[0] not in runs:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def sync(self):
+        """Wait until records put before are written."""
+        event = threading.Event()
+        self.queue.put(event)
+        event.wait()
+
+    def stop(self):
+        self.queue.put(LogWriter._stop_marker)
+        self.join()
 
 
 class Logger:
     _instance = None
     _default_log_directory = os.path.expanduser("~/.bonesinger-log/")
 
-    def init(self, directory=None):
+    def __init__(self):
+        self.writer = None
+
+    def init(self, directory=None, **writer_options):
         if directory is None:
             directory = Logger._default_log_directory
 
         self.directory = os.path.expanduser(directory)
         self.logname = self.generate_logfile_name()
-        self.file = self.create_logfile(self.directory, self.logname)
-        self.lastflush = time.time()
+        self.run_id = uuid.uuid4().hex[:12]
+        self.writer = self.create_logfile(self.directory, self.logname, **writer_options)
+        self.writer.start()
+        atexit.register(self.close_log)
 
     def generate_logfile_name(self):
         date = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-        return f"log-{date}.txt"
+        return f"log-{date}.jsonl"
 
-    def create_logfile(self, directory, name):
+    def create_logfile(self, directory, name, **writer_options):
         print("Create logfile", directory, name)
         if not os.path.exists(directory):
             os.makedirs(directory)
@@ -30,23 +317,61 @@ class Logger:
         if os.path.exists(path):
             os.remove(path)
 
-        # open the file
-        return open(path, 'w')
+        return LogWriter(directory, name, self.run_id, **writer_options)
 
-    def print(self, *args):
+    def print(self, *args, stream="log"):
+        """Log a line. stream is "log" for messages of bonesinger itself
+        and "output" for output of steps."""
         strargs = [str(arg) for arg in args]
-        print(*strargs)
-        self.file.write(" ".join(strargs) + "\n")
+        if self.writer is None:
+            print(*strargs)
+            return
+        self.writer.put((time.time(), log_context.get(), stream, " ".join(strargs)))
+
+    def status(self, status, message=""):
+        """Record final status of the step of current context."""
+        if self.writer is None:
+            return
+        self.writer.put((time.time(), log_context.get(), "status",
+                         status if not message else f"{status}: {message}"))
 
-        if time.time() - self.lastflush > 5:
-            print("Flush logfile")
-            self.file.flush()
-            self.lastflush = time.time()
+    @contextlib.contextmanager
+    def context(self, **fields):
+        """Tag records logged inside with fields (pipeline, step, matrix)."""
+        token = log_context.set({**log_context.get(), **fields})
+        try:
+            yield
+        finally:
+            log_context.reset(token)
+
+    def add_listener(self, listener):
+        """listener(records) gets every written batch of records,
+        in the log writer thread."""
+        if self.writer is not None:
+            self.writer.listeners = self.writer.listeners + [listener]
+
+    def remove_listener(self, listener):
+        if self.writer is not None:
+            self.writer.listeners = [item for item in self.writer.listeners
+                                     if item is not listener]
+
+    def sync(self):
+        if self.writer is not None:
+            self.writer.sync()
+
+    async def drain(self):
+        """Wait while the log writer is behind. Readers of step output
+        await it after every line, so output is not read faster than it
+        is written."""
+        while self.writer is not None and self.writer.behind:
+            await asyncio.sleep(0.01)
 
     def close_log(self):
+        writer, self.writer = self.writer, None
+        if writer is None:
+            return
+        writer.stop()
         print("Close logfile")
-        self.file.flush()
-        self.file.close()
 
     @staticmethod
     def instance():
@@ -55,15 +380,101 @@ class Logger:
         return Logger._instance
 
     @staticmethod
-    def print_last_log(directory=None):
-        if directory is None:
-            directory = Logger._default_log_directory
+    def log_parts(directory, run_name):
+        """Files of one run in write order, compressed ones included."""
+        stem = run_name.split(".")[0]
+        return sorted((name for name in os.listdir(directory)
+                       if name.split(".")[0] == stem and not name.endswith((".tmp", ".idx"))),
+                      key=log_part_key)
+
+    @staticmethod
+    def open_log_part(directory, name):
+        """Open part of log by its name in index, compressed or not."""
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            return open(path, 'rb')
+        return gzip.open(path + ".gz", 'rb')
+
+    @staticmethod
+    def read_range(f, start, end):
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+    @staticmethod
+    def select_ranges(directory, run_name, pipeline=None, step=None, failed_only=False):
+        """(part, start, end) of records of matching steps, in write order.
+        Without index (logs of older versions) whole parts are returned."""
+        index_path = LogWriter.index_path(directory, run_name)
+        if not os.path.exists(index_path):
+            return [(name[:-3] if name.endswith(".gz") else name, 0, None)
+                    for name in Logger.log_parts(directory, run_name)]
+
+        ranges = []
+        statuses = {}
+        with open(index_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line of the index of a run which is still writing
+                    continue
+                if "status" in entry:
+                    statuses[context_key(entry)] = entry["status"]
+                    continue
+                if pipeline and entry.get("pipeline") != pipeline:
+                    continue
+                if step and entry.get("step") != step:
+                    continue
+                ranges.append(entry)
+
+        if failed_only:
+            ranges = [entry for entry in ranges
+                      if not statuses.get(context_key(entry), "success").startswith("success")]
+        return [(entry["part"], entry["start"], entry["end"]) for entry in ranges]
+
+    @staticmethod
+    def last_run_name(directory):
         # get last modified file in directory
-        files = os.listdir(directory)
+        files = [name for name in os.listdir(directory) if not name.endswith((".tmp", ".idx"))]
         files.sort(key=lambda x: os.path.getmtime(os.path.join(directory, x)))
+        return files[-1]
+
+    @staticmethod
+    def print_last_log(directory=None, pipeline=None, step=None, tail=None, failed_only=False):
+        """Print records of the last run, optionally only of some steps
+        and only last tail lines. Only the byte ranges of selected steps
+        are read, with help of the index."""
+        if directory is None:
+            directory = Logger._default_log_directory
+        run_name = Logger.last_run_name(directory)
+        print("Last log:", run_name)
 
-        print("Last log:", files[-1])
+        ranges = Logger.select_ranges(directory, run_name, pipeline, step, failed_only)
+        lines = collections.deque(maxlen=tail) if tail else None
+        opened = {}
+        try:
+            for part, start, end in ranges:
+                if part not in opened:
+                    opened[part] = Logger.open_log_part(directory, part)
+                for raw in Logger.read_range(opened[part], start, end if end is not None else float("inf")):
+                    try:
+                        record = json.loads(raw)
+                    except ValueError:
+                        # plain text log of older versions
+                        record = {"line": raw.decode("utf-8", "replace").rstrip("\n")}
+                    if record.get("stream") == "status":
+                        continue
+                    if lines is not None:
+                        lines.append(record["line"])
+                    else:
+                        print(record["line"])
+        finally:
+            for f in opened.values():
+                f.close()
 
-        # print the last file
-        with open(os.path.join(directory, files[-1]), 'r') as f:
-            print(f.read())
+        for line in lines or []:
+            print(line)
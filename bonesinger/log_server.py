@@ -0,0 +1,145 @@
+import asyncio
+import collections
+import json
+import urllib.parse
+from .log import Logger
+
+logger = Logger.instance()
+
+
+def parse_listen_address(text):
+    """[host:]port; host is 127.0.0.1 by default."""
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class LogStreamClient:
+    """Connected client with its filters and a bounded queue of records.
+    When the client reads slower than records arrive, the oldest ones are
+    dropped and the client is told how many it missed."""
+
+    def __init__(self, writer, filters, buffer_size):
+        self.writer = writer
+        self.filters = filters
+        self.records = collections.deque(maxlen=buffer_size)
+        self.dropped = 0
+        self.ready = asyncio.Event()
+        self.closed = False
+
+    def matches(self, record):
+        return all(record.get(field) == value for field, value in self.filters.items())
+
+    def push(self, record):
+        if not self.matches(record):
+            return
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append(record)
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+
+class LogStreamServer:
+    """Streams log records of the running job over HTTP as server-sent
+    events, one JSON record per event:
+
+        curl -N 'http://127.0.0.1:PORT/events?pipeline=NAME&step=NAME'
+
+    Records come from the log writer thread and are handed to the event
+    loop in batches, so step execution never waits for clients. The last
+    history_size records are kept and sent to new clients first."""
+
+    def __init__(self, host="127.0.0.1", port=0, history_size=1000, buffer_size=10000):
+        self.host = host
+        self.port = port
+        self.history = collections.deque(maxlen=history_size)
+        self.buffer_size = buffer_size
+        self.clients = set()
+        self.handlers = set()
+        self.server = None
+        self.loop = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.add_listener(self.publish)
+        logger.print(f"Log stream: http://{self.host}:{self.port}/events")
+
+    async def stop(self):
+        # records dispatched before sync returns are handed to clients first
+        await asyncio.to_thread(logger.sync)
+        logger.remove_listener(self.publish)
+        for client in list(self.clients):
+            client.close()
+        self.server.close()
+        if self.handlers:
+            # let clients receive the rest of records and the end event
+            await asyncio.wait(self.handlers, timeout=5)
+        await self.server.wait_closed()
+
+    def publish(self, records):
+        """Called from the log writer thread."""
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.dispatch, records)
+
+    def dispatch(self, records):
+        self.history.extend(records)
+        for client in self.clients:
+            for record in records:
+                client.push(record)
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.handlers.add(task)
+        try:
+            request_line = await reader.readline()
+            # skip headers
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            url = urllib.parse.urlsplit(parts[1] if len(parts) > 1 else "/")
+            if len(parts) < 2 or parts[0] != "GET" or url.path != "/events":
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n"
+                             b"Connection: close\r\n\r\n")
+                await writer.drain()
+                return
+
+            filters = {field: values[-1]
+                       for field, values in urllib.parse.parse_qs(url.query).items()
+                       if field in ("pipeline", "step", "stream")}
+            await self.stream(writer, filters)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            self.handlers.discard(task)
+
+    async def stream(self, writer, filters):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+        client = LogStreamClient(writer, filters, self.buffer_size)
+        for record in self.history:
+            client.push(record)
+        self.clients.add(client)
+        try:
+            while True:
+                await client.ready.wait()
+                client.ready.clear()
+                chunks = []
+                if client.dropped:
+                    chunks.append(f"event: dropped\ndata: {client.dropped}\n\n")
+                    client.dropped = 0
+                while client.records:
+                    chunks.append("data: " + json.dumps(client.records.popleft(), default=str) + "\n\n")
+                if client.closed:
+                    chunks.append("event: end\ndata: \n\n")
+                writer.write("".join(chunks).encode("utf-8"))
+                await writer.drain()
+                if client.closed:
+                    break
+        finally:
+            self.clients.discard(client)
@@ -0,0 +1,190 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from .log import Logger
+from .report import RunReport
+
+logger = Logger.instance()
+
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0, math.inf)
+
+# name: (type, help)
+METRICS = {
+    "bonesinger_step_duration_seconds": ("histogram", "Duration of steps"),
+    "bonesinger_steps_running": ("gauge", "Steps being executed"),
+    "bonesinger_steps_queued": ("gauge", "Steps waiting for the steps they need"),
+    "bonesinger_cells_running": ("gauge", "Matrix values being executed"),
+    "bonesinger_cells_queued": ("gauge", "Matrix values waiting for a free job"),
+    "bonesinger_containers_live": ("gauge", "Docker containers used by the run"),
+    "bonesinger_clone_seconds": ("counter", "Time spent cloning repositories"),
+    "bonesinger_clone_bytes": ("counter", "Size of objects of cloned repositories"),
+    "bonesinger_clones": ("counter", "Cloned repositories"),
+    "bonesinger_pipeline_runs": ("counter", "Finished pipelines by status"),
+    "bonesinger_last_run_timestamp_seconds": ("gauge", "Time the last run finished"),
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    text = ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                                     .replace("\"", "\\\"").replace("\n", "\\n"))
+                    for name, value in labels)
+    return "{" + text + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Counters, gauges and histograms of the run in OpenMetrics text
+    format. Updates are a dictionary change under a lock; most of them
+    come from RunReport spans, so step execution does not call it
+    directly. Until enable() is called nothing is collected, and callers
+    check enabled before doing work only needed for metrics."""
+
+    _instance = None
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        # name -> {labels tuple: value}
+        self.values = {name: {} for name in METRICS}
+        # labels tuple -> [bucket counts, sum, count]
+        self.histograms = {}
+
+    @staticmethod
+    def instance():
+        if Metrics._instance is None:
+            Metrics._instance = Metrics()
+        return Metrics._instance
+
+    def enable(self):
+        self.enabled = True
+        RunReport.instance().listeners.append(self.on_span)
+
+    def finish_run(self):
+        self.set("bonesinger_last_run_timestamp_seconds", time.time())
+
+    def add(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            histogram = self.histograms.setdefault((name, key), [[0] * len(DURATION_BUCKETS), 0.0, 0])
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def on_span(self, event, span):
+        """RunReport listener."""
+        category = span["category"]
+        if category == "step":
+            if event == "start":
+                self.add("bonesinger_steps_running", 1)
+            else:
+                self.add("bonesinger_steps_running", -1)
+                self.observe("bonesinger_step_duration_seconds", span["end"] - span["start"],
+                             pipeline=span["pipeline"], step=span["name"])
+        elif category == "cell":
+            self.add("bonesinger_cells_running", 1 if event == "start" else -1)
+        elif category == "pipeline" and event == "end":
+            self.add("bonesinger_pipeline_runs", 1, pipeline=span["name"], status=span["status"])
+        elif category == "clone" and event == "end":
+            pipeline = span["pipeline"]
+            self.add("bonesinger_clones", 1, pipeline=pipeline)
+            self.add("bonesinger_clone_seconds", span["end"] - span["start"], pipeline=pipeline)
+            if "bytes" in span["args"]:
+                self.add("bonesinger_clone_bytes", span["args"]["bytes"], pipeline=pipeline)
+
+    def render(self, openmetrics=True):
+        """Text exposition; openmetrics=False gives Prometheus text format
+        for node_exporter textfile collector."""
+        lines = []
+        with self.lock:
+            for name, (kind, help_text) in METRICS.items():
+                family = name
+                if kind == "counter" and not openmetrics:
+                    family = name + "_total"
+                lines.append(f"# TYPE {family} {kind}")
+                lines.append(f"# HELP {family} {help_text}")
+                if kind == "histogram":
+                    for (histogram_name, labels), (buckets, total, count) in self.histograms.items():
+                        if histogram_name != name:
+                            continue
+                        for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                            bucket_labels = format_labels(labels + (("le", format_value(bound)),))
+                            lines.append(f"{name}_bucket{bucket_labels} {bucket_count}")
+                        lines.append(f"{name}_count{format_labels(labels)} {count}")
+                        lines.append(f"{name}_sum{format_labels(labels)} {format_value(total)}")
+                    continue
+                suffix = "_total" if kind == "counter" else ""
+                values = self.values[name] or ({(): 0} if kind == "gauge" else {})
+                for labels, value in values.items():
+                    lines.append(f"{name}{suffix}{format_labels(labels)} {format_value(value)}")
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Write metrics for node_exporter textfile collector, atomically."""
+        path = os.path.expanduser(path)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render(openmetrics=False))
+        os.replace(tmp_path, path)
+
+
+class MetricsServer:
+    """Serves Metrics on GET /metrics."""
+
+    def __init__(self, metrics, host="127.0.0.1", port=0):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.print(f"Metrics: http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2 or parts[0] != "GET" or parts[1].split("?")[0] != "/metrics":
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n"
+                             b"Connection: close\r\n\r\n")
+            else:
+                body = self.metrics.render().encode("utf-8")
+                writer.write(b"HTTP/1.1 200 OK\r\n"
+                             b"Content-Type: application/openmetrics-text; version=1.0.0; charset=utf-8\r\n"
+                             + f"Content-Length: {len(body)}\r\n".encode("ascii")
+                             + b"Connection: close\r\n\r\n" + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
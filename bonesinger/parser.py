@@ -3,12 +3,15 @@ from .log import Logger
 
 logger = Logger.instance()
 
+# libyaml based loader is much faster, pure python one is the fallback
+YamlLoader = getattr(yaml, "CLoader", yaml.Loader)
+
 
 def parse_yaml(file):
     with open(file, 'r') as stream:
         try:
             # create loader
-            loader = yaml.Loader(stream)
+            loader = YamlLoader(stream)
             return loader.get_data()
         except yaml.YAMLError as exc:
             raise exc
@@ -19,14 +22,17 @@ def parse_yaml_url(url):
         import requests
         r = requests.get(url)
         logger.print(f"download content from url: {url}:\n{r.text}")
-        return yaml.load(r.text)
+        return yaml.load(r.text, Loader=YamlLoader)
     else:
         return parse_yaml(url)
 
 
 def parse_yaml_content(content):
-    loader = yaml.Loader(content)
-    return loader.get_data()
+    loader = YamlLoader(content)
+    try:
+        return loader.get_data()
+    finally:
+        loader.dispose()
 
 
 def get_url_content(url):
@@ -1,11 +1,16 @@
-from bonesinger.util import strong_key_format
 from .step import Step
 from .util import merge_dicts
+from .template import Template
 import os
 import tempfile
 from git import Repo
 from .log import Logger
+from .report import RunReport
+from .metrics import Metrics
 import asyncio
+import hashlib
+import json
+from .incremental import remote_head
 
 logger = Logger.instance()
 
@@ -20,20 +25,66 @@ class Pipeline:
                  success_info: str,
                  workspace: str,
                  gitdata: dict,
-                 watchdog : int):
+                 watchdog : int,
+                 config_hash: str = None):
         self.name = name
         self.core = core
         self.steps = self.parse_steps(step_records, core)
+        self.step_dependencies = self.make_step_dependencies(self.steps)
         self.pipeline_subst = {"pipeline_name": name}
-        self.success_info_template = success_info
+        self.success_info_template = Template(success_info) if success_info is not None else None
         self.success_info = ""
         self.workspace = workspace
         self.gitdata = gitdata
         self.watchdog = watchdog
+        self.config_hash = config_hash
 
     def parse_steps(self, step_records, core):
         return [Step.from_record(record, pipeline=self, core=core) for record in step_records]
 
+    def make_step_dependencies(self, steps):
+        """Map step index to indexes of steps it needs.
+        Without 'needs' a step depends on the previous one, so pipelines
+        that do not use 'needs' keep strictly sequential order.
+        Returns None for such pipelines."""
+        if all(step.needs is None for step in steps):
+            return None
+
+        indexes = {}
+        for index, step in enumerate(steps):
+            if step.name in indexes:
+                raise Exception(f"Pipeline {self.name}: duplicate step name: {step.name}")
+            indexes[step.name] = index
+
+        dependencies = {}
+        for index, step in enumerate(steps):
+            if step.needs is None:
+                dependencies[index] = [index - 1] if index > 0 else []
+                continue
+            dependencies[index] = []
+            for need in step.needs:
+                if need not in indexes:
+                    raise Exception(f"Pipeline {self.name}: step {step.name} needs unknown step: {need}")
+                dependencies[index].append(indexes[need])
+
+        # Kahn's algorithm, just to reject cycles at parse time
+        remaining = {index: len(deps) for index, deps in dependencies.items()}
+        ready = [index for index, count in remaining.items() if count == 0]
+        visited = 0
+        while ready:
+            current = ready.pop()
+            visited += 1
+            for index, deps in dependencies.items():
+                if current in deps:
+                    remaining[index] -= 1
+                    if remaining[index] == 0:
+                        ready.append(index)
+        if visited != len(steps):
+            cycle = [steps[index].name for index, count in remaining.items() if count > 0]
+            raise Exception(f"Pipeline {self.name}: dependency cycle between steps: {cycle}")
+
+        return dependencies
+
     @staticmethod
     def from_record(record, core):
         name = record["name"]
@@ -43,7 +94,7 @@ class Pipeline:
 
         gitdata = None
         if workspace is None:
-            print("Create workspace of current pipeline")
+            logger.print("Create workspace of current pipeline")
             workspace = core.executor.make_temporary_directory()
 
         if "git" in record:
@@ -52,8 +103,15 @@ class Pipeline:
             gitbranch = git.get("branch", "master")
             gitcommit = git.get("commit", None)
             gitname = git.get("name", None)
+            gitsubmodules = git.get("submodules", "recursive")
+            if gitsubmodules not in ("recursive", "shallow", "none"):
+                raise Exception(f"Pipeline {name}: invalid git submodules mode: {gitsubmodules}")
             gitdata = {"url": giturl, "branch": gitbranch,
-                       "commit": gitcommit, "name": gitname}
+                       "commit": gitcommit, "name": gitname,
+                       "depth": git.get("depth", None),
+                       "filter": git.get("filter", None),
+                       "sparse": git.get("sparse", None),
+                       "submodules": gitsubmodules}
             if success_info is None:
                 success_info = ("Pipeline {{pipeline_name}} has been successfully executed.\n" +
                                 "Commit hash: {{commit_hash}}\n" +
@@ -78,10 +136,31 @@ class Pipeline:
                 success_info=success_info,
                 workspace=workspace,
                 gitdata=gitdata,
-                watchdog=watchdog)
+                watchdog=watchdog,
+                config_hash=hashlib.sha256(
+                    json.dumps(record, sort_keys=True, default=str).encode("utf-8")).hexdigest())
 
     async def execute(self, executor, matrix_value, prefix, subst):
-        self.core.executor.chdir(self.workspace)
+        with logger.context(pipeline=self.name, step=None), \
+                RunReport.instance().span("pipeline", self.name):
+            return await self.execute_in_session(executor, matrix_value, prefix, subst)
+
+    async def execute_in_session(self, executor, matrix_value, prefix, subst):
+        if not executor.session_mode:
+            return await self.execute_body(executor, matrix_value, prefix, subst)
+
+        executor = await executor.start_session()
+        try:
+            await self.execute_body(executor, matrix_value, prefix, subst)
+        finally:
+            await executor.close_session()
+
+    async def execute_body(self, executor, matrix_value, prefix, subst):
+        executor.chdir(self.workspace)
+
+        if self.gitdata and self.core.incremental_state is not None:
+            if await self.skip_if_up_to_date(matrix_value):
+                return
 
         # clone repository if pipeline has git section
         if self.gitdata:
@@ -90,9 +169,19 @@ class Pipeline:
             branch = self.gitdata.get("branch", None)
             logger.print(self.gitdata)
             logger.print(f"Clone repository: {url} {name}")
-            info = self.core.executor.clone_repository(url, name, basepath=self.workspace, branch=branch)
+            with RunReport.instance().span("clone", name, branch=branch) as span:
+                info = await asyncio.to_thread(executor.clone_repository,
+                                               url, name, basepath=self.workspace, branch=branch,
+                                               commit=self.gitdata.get("commit", None),
+                                               depth=self.gitdata.get("depth", None),
+                                               filter_spec=self.gitdata.get("filter", None),
+                                               sparse=self.gitdata.get("sparse", None),
+                                               submodules=self.gitdata.get("submodules", "recursive"))
+                span["args"]["commit"] = info["commit"]
+                if info.get("bytes") is not None:
+                    span["args"]["bytes"] = info["bytes"]
             self.workspace = os.path.join(self.workspace, name)
-            self.core.executor.chdir(self.workspace)
+            executor.chdir(self.workspace)
             self.pipeline_subst["commit_hash"] = info["commit"]
             self.pipeline_subst["commit_message"] = info["message"]
 
@@ -113,29 +202,112 @@ class Pipeline:
             raise PipelineTimeoutException()
 
         if self.success_info_template is not None:
-            self.success_info = strong_key_format(self.success_info_template,
-                                                  merge_dicts(self.pipeline_subst,
-                                                              matrix_value,
-                                                              {"success_info": self.success_info}))
+            self.success_info = self.success_info_template.render(
+                merge_dicts(self.pipeline_subst,
+                            matrix_value,
+                            {"success_info": self.success_info}),
+                self.core.undefined_variables)
             if self.core.is_debug_mode():
                 logger.print(f"Success info: {self.success_info}")
 
+        if self.gitdata and self.core.incremental_state is not None:
+            self.core.incremental_state.record_success(self.name, matrix_value,
+                                                       self.pipeline_subst["commit_hash"],
+                                                       self.pipeline_subst["commit_message"],
+                                                       self.config_hash,
+                                                       self.success_info)
+
+    async def skip_if_up_to_date(self, matrix_value):
+        """In incremental mode reuse result of the last successful run
+        if remote commit and configuration have not changed."""
+        state = self.core.incremental_state
+        commit = self.gitdata.get("commit", None)
+        if not commit:
+            commit = await asyncio.to_thread(remote_head, self.gitdata["url"],
+                                             self.gitdata.get("branch", None))
+        if not commit:
+            return False
+
+        record = state.lookup(self.name, matrix_value, commit, self.config_hash)
+        if record is None:
+            return False
+
+        logger.print(f"Pipeline {self.name} is up to date at {commit}, skipped")
+        self.pipeline_subst["commit_hash"] = record["commit"]
+        self.pipeline_subst["commit_message"] = record["message"]
+        self.success_info = record["success_info"]
+        state.mark_skipped(self.name, matrix_value, commit)
+        return True
+
     def set_variable(self, variable_name, variable_value):
         self.pipeline_subst[variable_name] = variable_value
 
-    async def execute_do(self, executor, matrix_value, prefix, subst):
-        for step in self.steps:
+    async def execute_step(self, step, executor, matrix_value, prefix, subst):
+        with logger.context(step=step.name), RunReport.instance().span("step", step.name):
             if self.core.is_debug_mode():
                 logger.print(
                     f"Execute step {step.name} for matrix value: {matrix_value}")
             try:
                 logger.print("Chdir to workspace of current pipeline: " + self.workspace)
-                self.core.executor.chdir(self.workspace)
-                await step.execute(pipeline_name=self.name,
-                             executor=executor,
-                             matrix=matrix_value,
-                             prefix=prefix,
-                             subst=merge_dicts(self.pipeline_subst, subst))
+                executor.chdir(self.workspace)
+                result = await step.execute(pipeline_name=self.name,
+                                            executor=executor,
+                                            matrix=matrix_value,
+                                            prefix=prefix,
+                                            subst=merge_dicts(self.pipeline_subst, subst))
+            except asyncio.CancelledError:
+                logger.status("cancelled")
+                raise
             except Exception as e:
                 logger.print(f"Error in step {step.name}: {e}")
-                raise e
\ No newline at end of file
+                logger.status("failed", str(e))
+                raise e
+            logger.status("success")
+            return result
+
+    async def execute_do(self, executor, matrix_value, prefix, subst):
+        if self.step_dependencies is None:
+            results = []
+            for step in self.steps:
+                results.append(await self.execute_step(step, executor, matrix_value, prefix, subst))
+        else:
+            results = await self.execute_graph(executor, matrix_value, prefix, subst)
+
+        # appended in declaration order regardless of completion order
+        for result in results:
+            if result is not None:
+                self.success_info += result
+
+    async def execute_graph(self, executor, matrix_value, prefix, subst):
+        """Start every step as soon as the steps it needs are finished.
+        Each step gets its own executor fork, so concurrent steps do not
+        share the current directory. The first failure cancels the rest."""
+        tasks = []
+        metrics = Metrics.instance()
+
+        async def run(index):
+            if metrics.enabled:
+                metrics.add("bonesinger_steps_queued", 1)
+            try:
+                await asyncio.gather(*[tasks[dep] for dep in self.step_dependencies[index]])
+            finally:
+                if metrics.enabled:
+                    metrics.add("bonesinger_steps_queued", -1)
+            return await self.execute_step(self.steps[index], executor.fork(),
+                                           matrix_value, prefix, subst)
+
+        # dependencies may point forward, so create all tasks before any runs
+        for index in range(len(self.steps)):
+            tasks.append(asyncio.ensure_future(run(index)))
+
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        return [task.result() for task in tasks]
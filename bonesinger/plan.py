@@ -0,0 +1,136 @@
+import hashlib
+import os
+import pickle
+from .parser import parse_yaml_content
+from .includes import IncludeResolver
+from .core import Core, index_by_name
+from .step import parse_needs_record
+from .util import merge_dicts_and_lists
+from .log import Logger
+
+logger = Logger.instance()
+
+# bump when the plan layout changes, so old cached plans are not used
+PLAN_FORMAT = 3
+
+
+class PlanCache:
+    """Parsed sources keyed by content hash and compiled plans keyed by
+    hashes of all their sources, pickled under ~/.bonesinger-cache/."""
+
+    _default_directory = os.path.expanduser("~/.bonesinger-cache/")
+
+    def __init__(self, directory=None):
+        self.directory = os.path.expanduser(directory or PlanCache._default_directory)
+
+    def path(self, kind, key):
+        return os.path.join(self.directory, kind, key + ".pickle")
+
+    def load(self, kind, key):
+        try:
+            with open(self.path(kind, key), "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def store(self, kind, key, value):
+        path = self.path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+class ExecutionPlan:
+    """Merged configuration of all sources with includes resolved and
+    pipeline templates applied, validated as a whole."""
+
+    def __init__(self, config, sources):
+        self.config = config
+        self.sources = sources
+
+    def pipeline_names(self):
+        return [record["name"] for record in self.config["pipeline"]]
+
+
+def parse_source(content, cache):
+    """Parse yaml content and find its '#!include' lines,
+    reusing the result for unchanged content."""
+    key = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    parsed = cache.load("parsed", key) if cache is not None else None
+    if parsed is None:
+        line_includes = [line[len("#!include"):].strip()
+                         for line in content.splitlines() if line.startswith("#!include")]
+        parsed = {"dict": parse_yaml_content(content), "line_includes": line_includes}
+        if cache is not None:
+            cache.store("parsed", key, parsed)
+    return key, parsed
+
+
+def expand_pipeline_record(record, templates):
+    while "use_template" in record:
+        template_name = record["use_template"]
+        if template_name not in templates:
+            raise Exception(f"Pipeline {record['name']}: template not found: {template_name}")
+        record = Core.compile_pipeline_record(name=record["name"],
+                                              template=templates[template_name],
+                                              subst=dict(record.get("args", {})))
+    return record
+
+
+def validate_pipeline_record(record, pipeline_names):
+    name = record["name"]
+    if "steps" not in record:
+        raise Exception(f"Pipeline {name}: no steps")
+    step_names = set(step.get("name") for step in record["steps"])
+    for step in record["steps"]:
+        if "name" not in step:
+            raise Exception(f"Pipeline {name}: step without name: {step}")
+        if not any(kind in step for kind in ("run", "run_pipeline", "set_variable")):
+            raise Exception(f"Pipeline {name}: invalid step record: {step}")
+        if "run_pipeline" in step and step["run_pipeline"] not in pipeline_names:
+            raise Exception(f"Pipeline {name}: step {step['name']} runs unknown pipeline: "
+                            f"{step['run_pipeline']}")
+        if "needs" in step:
+            step["needs"] = parse_needs_record(step["needs"], step["name"])
+        for need in step.get("needs", None) or []:
+            if need not in step_names:
+                raise Exception(f"Pipeline {name}: step {step['name']} needs unknown step: {need}")
+
+
+def compile_plan(dicts, sources):
+    config = merge_dicts_and_lists(*dicts)
+    if "pipeline" not in config:
+        raise Exception("No pipelines in scripts")
+
+    templates = index_by_name(config.get("pipeline_template", []), "pipeline template")
+    records = [expand_pipeline_record(record, templates) for record in config["pipeline"]]
+    index = index_by_name(records, "pipeline")
+    for record in records:
+        validate_pipeline_record(record, index)
+
+    config["pipeline"] = records
+    return ExecutionPlan(config, sources)
+
+
+async def load_plan(pathes, cache=None, http_cache=None):
+    """Compiled plan of scripts. With cache, unchanged sources are not
+    parsed again and an unchanged set of sources reuses the stored plan."""
+    resolver = IncludeResolver(lambda content: parse_source(content, cache), http_cache)
+    dicts, sources = await resolver.resolve(pathes)
+
+    digest = hashlib.sha256(f"plan format {PLAN_FORMAT}\n".encode("utf-8"))
+    for path, key in sources:
+        digest.update(f"{path}\n{key}\n".encode("utf-8"))
+    plan_key = digest.hexdigest()
+
+    if cache is not None:
+        plan = cache.load("plans", plan_key)
+        if plan is not None:
+            return plan
+
+    plan = compile_plan(dicts, sources)
+    if cache is not None:
+        cache.store("plans", plan_key, plan)
+    return plan
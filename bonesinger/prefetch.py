@@ -0,0 +1,57 @@
+import asyncio
+from .core import Core, index_by_name
+from .log import Logger
+
+logger = Logger.instance()
+
+
+def reachable_pipeline_records(pipeline_records, pipeline_templates, entrance):
+    """Records of pipelines reachable from entrance through run_pipeline
+    steps, with templates applied."""
+    by_name = index_by_name(pipeline_records, "pipeline")
+    templates = index_by_name(pipeline_templates, "pipeline template")
+
+    def resolve(record):
+        while "use_template" in record:
+            template_name = record["use_template"]
+            if template_name not in templates:
+                raise Exception("Pipeline template not found: " + template_name)
+            record = Core.compile_pipeline_record(name=record["name"],
+                                                  template=templates[template_name],
+                                                  subst=dict(record.get("args", {})))
+        return record
+
+    result = []
+    visited = set()
+    queue = [entrance]
+    while queue:
+        name = queue.pop(0)
+        if name in visited:
+            continue
+        visited.add(name)
+        if name not in by_name:
+            raise Exception("Pipeline not found: " + name)
+        record = resolve(by_name[name])
+        result.append(record)
+        for step in record.get("steps", []):
+            if "run_pipeline" in step:
+                queue.append(step["run_pipeline"])
+    return result
+
+
+async def prefetch_repositories(git_cache, records, jobs):
+    """Update git mirrors of all repositories used by records,
+    at most jobs at the same time."""
+    semaphore = asyncio.Semaphore(max(1, jobs))
+    sources = {}
+    for record in records:
+        if "git" in record:
+            git = record["git"]
+            sources[git["url"]] = git.get("branch", "master")
+
+    async def fetch(url, branch):
+        async with semaphore:
+            await asyncio.to_thread(git_cache.prefetch, url, branch)
+
+    logger.print(f"Prefetch {len(sources)} repositories")
+    await asyncio.gather(*[fetch(url, branch) for url, branch in sources.items()])
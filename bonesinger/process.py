@@ -0,0 +1,72 @@
+import asyncio
+import os
+import signal
+import subprocess
+import threading
+
+
+class ChildProcess:
+    """Subprocess with asyncio pipes which is reaped with wait4, so that
+    its resource usage is known. Usage of a shell includes usage of the
+    commands it has waited for.
+
+    Interface is the subset of asyncio.subprocess.Process used by
+    executors: stdin, stdout, wait(), kill(), returncode."""
+
+    def __init__(self, popen, stdout, stdin):
+        self.popen = popen
+        self.pid = popen.pid
+        self.stdout = stdout
+        self.stdin = stdin
+        self.returncode = None
+        self.rusage = None
+        self.exited = asyncio.get_running_loop().create_future()
+
+    @staticmethod
+    async def start(cmd, cwd=None, stdin=False, limit=2 ** 16):
+        """Start cmd with stdout and stderr merged into self.stdout
+        and, if stdin is true, a pipe to its stdin as self.stdin."""
+        loop = asyncio.get_running_loop()
+        popen = subprocess.Popen(cmd, cwd=cwd,
+                                 stdin=subprocess.PIPE if stdin else None,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT,
+                                 # own process group, so kill() reaches commands of the script
+                                 start_new_session=True)
+
+        stdout = asyncio.StreamReader(limit=limit, loop=loop)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stdout, loop=loop),
+                                     popen.stdout)
+        writer = None
+        if stdin:
+            transport, protocol = await loop.connect_write_pipe(
+                lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader(loop=loop), loop=loop),
+                popen.stdin)
+            writer = asyncio.StreamWriter(transport, protocol, None, loop)
+
+        process = ChildProcess(popen, stdout, writer)
+        threading.Thread(target=process.reap, args=(loop,), daemon=True,
+                         name=f"bonesinger-wait-{popen.pid}").start()
+        return process
+
+    def reap(self, loop):
+        _, status, rusage = os.wait4(self.pid, 0)
+        loop.call_soon_threadsafe(self.set_exited, os.waitstatus_to_exitcode(status), rusage)
+
+    def set_exited(self, returncode, rusage):
+        self.returncode = returncode
+        self.rusage = rusage
+        # keep Popen from waiting for the reaped process itself
+        self.popen.returncode = returncode
+        if not self.exited.done():
+            self.exited.set_result(returncode)
+
+    async def wait(self):
+        return await asyncio.shield(self.exited)
+
+    def kill(self):
+        if self.returncode is None:
+            try:
+                os.killpg(self.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,157 @@
+import asyncio
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from .log import Logger, log_context
+
+logger = Logger.instance()
+
+# span of the code which is running, resource usage of processes goes to it
+current_span = contextvars.ContextVar("bonesinger_current_span", default=None)
+
+
+class RunReport:
+    """Timings of matrix cells, pipelines, steps, clones and image builds,
+    with CPU time and peak RSS of step processes where the executor can
+    measure them. Usage of a step also counts for the spans enclosing it
+    (pipelines, matrix cell). Written at the end of run as JSON report
+    and as Chrome trace_event file (chrome://tracing, ui.perfetto.dev).
+
+    Peak RSS of a process is at least the RSS of bonesinger at the
+    moment it was spawned (the kernel counts the shared memory of vfork)."""
+
+    _instance = None
+
+    def __init__(self):
+        self.start = time.time()
+        self.spans = []
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        # id -> span of spans which have not ended
+        self.open_spans = {}
+        # listener(event, span), event is "start" or "end"
+        self.listeners = []
+
+    @staticmethod
+    def instance():
+        if RunReport._instance is None:
+            RunReport._instance = RunReport()
+        return RunReport._instance
+
+    @contextlib.contextmanager
+    def span(self, category, name, **args):
+        """Measure wall time of the block. Pipeline, step and matrix
+        value are taken from the log context."""
+        context = log_context.get()
+        parent = current_span.get()
+        span = {"id": next(self.ids), "parent": parent["id"] if parent is not None else None,
+                "category": category, "name": name,
+                "pipeline": context.get("pipeline"), "step": context.get("step"),
+                "matrix": context.get("matrix"), "args": args,
+                "start": time.time(), "end": None, "status": "success"}
+        token = current_span.set(span)
+        self.open_spans[span["id"]] = span
+        for listener in self.listeners:
+            listener("start", span)
+        try:
+            yield span
+        except BaseException as e:
+            span["status"] = "cancelled" if isinstance(e, asyncio.CancelledError) else "failed"
+            raise
+        finally:
+            span["end"] = time.time()
+            current_span.reset(token)
+            self.open_spans.pop(span["id"], None)
+            with self.lock:
+                self.spans.append(span)
+            for listener in self.listeners:
+                listener("end", span)
+
+    async def measure(self, category, name, awaitable, **args):
+        with self.span(category, name, **args):
+            return await awaitable
+
+    @staticmethod
+    def set_arg(name, value):
+        span = current_span.get()
+        if span is not None:
+            span["args"][name] = value
+
+    @staticmethod
+    def add_usage(rusage):
+        """Add resource usage of a finished process to the current span
+        and to the spans enclosing it: CPU times are summed, peak RSS is
+        the maximum."""
+        report = RunReport.instance()
+        span = current_span.get()
+        while span is not None:
+            args = span["args"]
+            args["utime"] = args.get("utime", 0.0) + rusage.ru_utime
+            args["stime"] = args.get("stime", 0.0) + rusage.ru_stime
+            # ru_maxrss is in kilobytes on Linux
+            args["max_rss_kb"] = max(args.get("max_rss_kb", 0), rusage.ru_maxrss)
+            span = report.open_spans.get(span["parent"])
+
+    def to_dict(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        return {"run": getattr(logger, "run_id", None),
+                "start": self.start,
+                "duration": time.time() - self.start,
+                "spans": [{**span, "duration": span["end"] - span["start"]} for span in spans]}
+
+    def trace_events(self):
+        """Complete ("X") events; every matrix cell gets its own thread
+        rows. A span is drawn under its parent span if the row is free,
+        concurrent spans (e.g. steps with 'needs:') go to other rows."""
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: (span["start"], span["start"] - span["end"]))
+        parents = {span["id"]: span["parent"] for span in spans}
+
+        def ancestors(span):
+            parent = span["parent"]
+            while parent is not None:
+                yield parent
+                parent = parents.get(parent)
+
+        events = []
+        lanes = {}
+        for span in spans:
+            cell = json.dumps(span["matrix"], sort_keys=True, default=str) \
+                if span["matrix"] is not None else "run"
+            cell_lanes = lanes.setdefault(cell, [])
+            for lane in cell_lanes:
+                stack = lane["stack"]
+                while stack and stack[-1]["end"] <= span["start"]:
+                    stack.pop()
+                if not stack or stack[-1]["id"] in set(ancestors(span)):
+                    break
+            else:
+                lane = {"tid": sum(len(item) for item in lanes.values()) + 1, "stack": []}
+                cell_lanes.append(lane)
+                events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": lane["tid"],
+                               "args": {"name": f"{cell} #{len(cell_lanes)}"}})
+            lane["stack"].append(span)
+
+            args = {key: span[key] for key in ("pipeline", "step", "status") if span[key] is not None}
+            args.update(span["args"])
+            events.append({"name": span["name"], "cat": span["category"], "ph": "X",
+                           "pid": 1, "tid": lane["tid"],
+                           "ts": (span["start"] - self.start) * 1e6,
+                           "dur": (span["end"] - span["start"]) * 1e6,
+                           "args": args})
+        return events
+
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        report_path = os.path.join(directory, "report.json")
+        trace_path = os.path.join(directory, "trace.json")
+        with open(report_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=1, default=str)
+        with open(trace_path, "w") as f:
+            json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms"}, f, default=str)
+        logger.print(f"Run report: {report_path}, trace: {trace_path}")
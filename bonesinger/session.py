@@ -0,0 +1,82 @@
+import asyncio
+import shlex
+from .util import generate_random_string, read_lines
+from .log import Logger
+
+logger = Logger.instance()
+
+
+class ShellSession:
+    """Long-lived bash-compatible interpreter which executes scripts sent
+    to its stdin. Every script runs in a subshell with stdin closed, so
+    'set -e', 'exit' and 'cd' of one script do not affect the session or
+    the next script. The end of script output and its exit code are
+    reported by a marker line with a random token."""
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = None
+        self.token = generate_random_string(16)
+        self.marker = f"__BONESINGER_{self.token}__"
+        self.lock = asyncio.Lock()
+
+    async def start(self):
+        logger.print("Start shell session:", " ".join(self.cmd))
+        self.proc = await asyncio.create_subprocess_exec(*self.cmd,
+                                                         stdin=asyncio.subprocess.PIPE,
+                                                         stdout=asyncio.subprocess.PIPE,
+                                                         stderr=asyncio.subprocess.STDOUT)
+
+    def make_command(self, text, directory):
+        delimiter = f"BONESINGER_EOF_{self.token}"
+        command = f"IFS= read -r -d '' __bonesinger_script <<'{delimiter}'\n"
+        command += text
+        if not text.endswith("\n"):
+            command += "\n"
+        command += f"{delimiter}\n"
+        command += "(\n"
+        if directory:
+            command += f"cd {shlex.quote(directory)} || exit\n"
+        command += "eval \"$__bonesinger_script\"\n"
+        command += ") < /dev/null\n"
+        command += f"printf '\\n%s %d\\n' '{self.marker}' $?\n"
+        return command
+
+    async def run(self, text, directory, on_line):
+        """Execute script text in directory, pass its output lines to
+        on_line and return its exit code."""
+        async with self.lock:
+            if self.proc.returncode is not None:
+                raise Exception(f"Shell session has exited with code {self.proc.returncode}")
+
+            self.proc.stdin.write(self.make_command(text, directory).encode("utf-8"))
+            try:
+                await self.proc.stdin.drain()
+                # the marker is preceded by a newline, which is not a part of
+                # the output; hold each line back until the next one arrives
+                pending = None
+                async for line in read_lines(self.proc.stdout):
+                    line = line.decode("utf-8", errors="replace")
+                    if line.startswith(self.marker):
+                        if pending is not None and pending != "\n":
+                            on_line(pending[:-1])
+                        return int(line[len(self.marker):].strip())
+                    if pending is not None:
+                        on_line(pending)
+                        await logger.drain()
+                    pending = line
+            except asyncio.CancelledError:
+                self.kill()
+                raise
+
+            raise Exception("Shell session has exited unexpectedly")
+
+    def kill(self):
+        if self.proc.returncode is None:
+            self.proc.kill()
+
+    async def close(self):
+        if self.proc.returncode is None:
+            self.proc.stdin.write(b"exit\n")
+            self.proc.stdin.close()
+        await self.proc.wait()
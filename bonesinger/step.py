@@ -1,9 +1,36 @@
 
 import json
+import re
 from .executors import StepExecutor
 from .util import merge_dicts
+from .template import Template
+from .step_cache import parse_cache_record
+from .capture import parse_capture_record, make_capture
 from .log import Logger
 
+logger = Logger.instance()
+
+
+# 'set -x' trace lines, "+ command" with one "+" per nesting level (default PS4)
+_trace_line_regex = re.compile(r"^\++ .*\n?", re.MULTILINE)
+
+
+def strip_trace(output: str) -> str:
+    """Output of a script without its 'set -x' trace lines, which are
+    merged into it with stderr. Output lines starting with "+ " are
+    indistinguishable from trace and are removed too."""
+    return _trace_line_regex.sub("", output)
+
+
+def parse_needs_record(record, step_name):
+    """Normalize step 'needs:' record to a list of step names without
+    repetitions. None means "the previous step"."""
+    if record is None:
+        return None
+    if not isinstance(record, list) or not all(isinstance(need, str) for need in record):
+        raise Exception(f"Step {step_name}: 'needs' must be a list of step names: {record!r}")
+    return list(dict.fromkeys(record))
+
 
 class obj:
 
@@ -20,8 +47,32 @@ def dict2obj(dict1):
 
 
 class Step:
+    # names of steps of the same pipeline which must be finished first,
+    # None means "the previous step"
+    needs = None
+
+    # normalized 'cache:' record of run and set_variable steps, None if off
+    cache = None
+
+    # normalized 'capture:' record of run steps, None for default
+    capture = None
+
     @staticmethod
     def from_record(step_record, pipeline, core):
+        step = Step.make_from_record(step_record, pipeline, core)
+        step.needs = parse_needs_record(step_record.get("needs", None), step.name)
+        if "cache" in step_record:
+            if isinstance(step, PipelineStep):
+                raise Exception("Cache is not supported for run_pipeline steps: " + str(step_record))
+            step.cache = parse_cache_record(step_record["cache"])
+        if "capture" in step_record:
+            if not isinstance(step, RunStep):
+                raise Exception("Capture mode is supported for run steps only: " + str(step_record))
+            step.capture = parse_capture_record(step_record["capture"])
+        return step
+
+    @staticmethod
+    def make_from_record(step_record, pipeline, core):
         name = step_record["name"]
         if "run" in step_record:
             run = step_record["run"]
@@ -43,7 +94,7 @@ class Step:
             return SetVariableStep(core=core,
                                    name=name,
                                    variable_name=variable_name,
-                                   run_lines=run_script.split("\n"),
+                                   script=Template(run_script),
                                    pipeline=pipeline)
         else:
             raise Exception("Invalid step record: " + str(step_record))
@@ -64,7 +115,7 @@ class PipelineStep(Step):
 
     async def execute(self, pipeline_name, executor: StepExecutor, matrix, prefix, subst: dict = {}):
         if self.core.is_debug_mode():
-            print("Execute PipelineStep: " + self.name)
+            logger.print("Execute PipelineStep: " + self.name)
 
         pipeline = self.core.find_pipeline(self.pipeline_name)
         await pipeline.execute(executor=executor,
@@ -73,7 +124,8 @@ class PipelineStep(Step):
                          subst=subst)
 
         if self.success_info_action == "append":
-            self.pipeline.success_info += pipeline.success_info + "\n"
+            return pipeline.success_info + "\n"
+        return None
 
 
 class SetVariableStep(Step):
@@ -82,25 +134,34 @@ class SetVariableStep(Step):
                  name: str,
                  variable_name: str,
                  pipeline,
-                 run_lines: list = None):
+                 script: Template = None):
         self.core = core
         self.name = name
         self.variable_name = variable_name
         self.pipeline = pipeline
-        self.run_lines = run_lines
+        self.script = script
 
     async def execute(self, pipeline_name, executor: StepExecutor, matrix, prefix, subst: dict = {}):
         if self.core.is_debug_mode():
-            print("Execute SetVariableStep: " + self.name)
-        output = executor.execute_script(
-            script_lines=self.run_lines,
-            pipeline_name=pipeline_name,
-            subst_dict=merge_dicts(subst, matrix),
-            prefix=prefix,
-            script_name=self.name,
-            debug=self.core.is_debug_mode())
-
-        self.pipeline.set_variable(self.variable_name, output.strip())
+            logger.print("Execute SetVariableStep: " + self.name)
+        # value of the variable is the whole output without the trace
+        capture = make_capture({"mode": "full"})
+        try:
+            await executor.execute_script(
+                script=self.script,
+                pipeline_name=pipeline_name,
+                subst_dict=merge_dicts(subst, matrix),
+                prefix=prefix,
+                script_name=self.name,
+                debug=self.core.is_debug_mode(),
+                cache=self.cache,
+                undefined=self.core.undefined_variables,
+                capture=capture)
+            output = capture.getvalue()
+        finally:
+            capture.close()
+
+        self.pipeline.set_variable(self.variable_name, strip_trace(output).strip())
 
 
 class RunStep(Step):
@@ -110,11 +171,17 @@ class RunStep(Step):
         self.core = core
         self.pipeline = pipeline
         self.name = name
-        self.run_lines = run.split("\n")
+        self.script = Template(run)
 
     def __str__(self):
         return f"Task({self.name})"
 
+    def capture_record(self):
+        # output is not used; step cache records it on its own
+        if self.capture is not None:
+            return self.capture
+        return {"mode": "none"}
+
     async def execute(self,
                 pipeline_name: str,
                 executor: StepExecutor,
@@ -122,11 +189,18 @@ class RunStep(Step):
                 prefix: str,
                 subst: dict = {}):
         if self.core.is_debug_mode():
-            print("Execute RunStep: " + self.name)
-        await executor.execute_script(
-            script_lines=self.run_lines,
-            pipeline_name=pipeline_name,
-            subst_dict=merge_dicts(subst, matrix),
-            prefix=prefix,
-            script_name=self.name,
-            debug=self.core.is_debug_mode())
+            logger.print("Execute RunStep: " + self.name)
+        capture = make_capture(self.capture_record())
+        try:
+            await executor.execute_script(
+                script=self.script,
+                pipeline_name=pipeline_name,
+                subst_dict=merge_dicts(subst, matrix),
+                prefix=prefix,
+                script_name=self.name,
+                debug=self.core.is_debug_mode(),
+                cache=self.cache,
+                undefined=self.core.undefined_variables,
+                capture=capture)
+        finally:
+            capture.close()
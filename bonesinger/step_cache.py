@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import re
+import time
+from .log import Logger
+
+logger = Logger.instance()
+
+
+def parse_cache_record(record):
+    """Normalize step 'cache:' record: true or {inputs: [globs]}.
+    Returns None if caching is off."""
+    if record is None or record is False:
+        return None
+    if record is True:
+        return {"inputs": []}
+    if isinstance(record, dict):
+        inputs = record.get("inputs", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        return {"inputs": list(inputs)}
+    raise Exception("Invalid step cache record: " + str(record))
+
+
+def glob_component_regex(part):
+    """Regex of one path component of a glob: * and ? do not cross "/"
+    and, like glob.glob, do not match a leading dot."""
+    regex = "(?!\\.)" if part[:1] in ("*", "?", "[") else ""
+    index = 0
+    while index < len(part):
+        char = part[index]
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[" and part.find("]", index + 2) > 0:
+            end = part.find("]", index + 2)
+            content = part[index + 1:end]
+            if content.startswith("!"):
+                content = "^" + content[1:]
+            regex += "[" + content.replace("\\", "\\\\") + "]"
+            index = end
+        else:
+            regex += re.escape(char)
+        index += 1
+    return regex
+
+
+def glob_regex(pattern):
+    """Compiled regex matching relative file paths like
+    glob.glob(pattern, recursive=True) does."""
+    parts = pattern.split("/")
+    regex = ""
+    for index, part in enumerate(parts):
+        last = index == len(parts) - 1
+        if part == "**":
+            # any number of directories, or any file below when last
+            regex += "(?:(?!\\.)[^/]+/)*" + ("(?!\\.)[^/]+" if last else "")
+        else:
+            regex += glob_component_regex(part) + ("" if last else "/")
+    return re.compile(regex + "\\Z")
+
+
+def glob_base(pattern):
+    """Leading directories of pattern without wildcards, where the
+    search for its files starts ("." if none)."""
+    literal = []
+    for part in pattern.split("/"):
+        if any(char in part for char in "*?["):
+            break
+        literal.append(part)
+    return "/".join(literal) or "."
+
+
+def match_inputs(paths, patterns):
+    """Sorted paths of files (relative, without "./") matching any of
+    glob patterns. Native and docker executors list files differently
+    but select them with this function, so they agree."""
+    regexes = [glob_regex(pattern) for pattern in patterns]
+    return sorted(path for path in paths if any(regex.match(path) for regex in regexes))
+
+
+def inputs_digest(file_hashes):
+    """Hash of (path, sha256 of content) pairs."""
+    digest = hashlib.sha256()
+    for path, file_hash in file_hashes:
+        digest.update(f"{path}\0{file_hash}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class StepCache:
+    """On-disk store of step results keyed by content hash.
+    The key covers everything the step result depends on as far as
+    bonesinger can see: rendered script, substitution variables (matrix
+    value and commit hash included), execution environment and hash of
+    declared input files. Least recently used entries are evicted when
+    the store grows over max_size bytes.
+
+    The size of the store is counted once per run and then grows by the
+    stored entries, so the store is scanned again only when it is full.
+    Eviction goes down to 3/4 of max_size to leave room for the next
+    stores; entries of concurrent runs are seen on the next scan."""
+
+    _default_directory = os.path.expanduser("~/.bonesinger-cache/steps/")
+
+    def __init__(self, directory=None, max_size=256 * 1024 * 1024):
+        self.directory = os.path.expanduser(directory or StepCache._default_directory)
+        self.max_size = max_size
+        # bytes in the store, None until scanned
+        self.size = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(text, subst_dict, environment, inputs_hash):
+        digest = hashlib.sha256()
+        for part in (text,
+                     json.dumps(subst_dict, sort_keys=True, default=str),
+                     environment,
+                     inputs_hash):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".out")
+
+    def load(self, key):
+        """Return recorded output as a text file open after the entry
+        header, or None. The caller closes it."""
+        path = self.entry_path(key)
+        try:
+            f = open(path, "r", encoding="utf-8")
+        except OSError:
+            return None
+        try:
+            json.loads(f.readline())
+        except ValueError:
+            f.close()
+            return None
+        # mtime is the LRU clock
+        os.utime(path)
+        return f
+
+    def store(self, key, chunks, pipeline_name, step_name):
+        """Record output given as iterable of strings. The entry is a
+        JSON header line followed by the output as is, so large output is
+        copied and replayed without holding it in memory."""
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"pipeline": pipeline_name, "step": step_name,
+                                "created": time.time()}) + "\n")
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, path)
+
+        if self.size is None:
+            self.size = self.scan()[1]
+        else:
+            self.size += os.path.getsize(path)
+        if self.size > self.max_size:
+            self.evict()
+
+    def scan(self):
+        """Entries as (mtime, size, path) and their total size."""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        return entries, total
+
+    def evict(self):
+        entries, total = self.scan()
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.size = total
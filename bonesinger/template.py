@@ -0,0 +1,57 @@
+import re
+from .log import Logger
+
+logger = Logger.instance()
+
+# {{name}}; names start with a letter or underscore and may contain
+# dots, so that e.g. docker format strings like {{.State.Running}} stay
+# literal text while {{build.type}} is a placeholder
+_placeholder_regex = re.compile(r"\{\{([A-Za-z_][\w.-]*)\}\}")
+
+UNDEFINED_MODES = ("error", "warn", "keep")
+
+
+class UndefinedVariableError(Exception):
+    pass
+
+
+class Template:
+    """Text with {{name}} placeholders, split into literal and variable
+    segments once, so rendering is a single join.
+
+    undefined selects what happens to placeholders without value:
+    "error" raises UndefinedVariableError, "warn" logs a warning and
+    keeps the placeholder, "keep" keeps it silently (for partial
+    substitution, e.g. of template arguments)."""
+
+    def __init__(self, source: str):
+        self.source = source
+        self.literals = []
+        self.names = []
+        position = 0
+        for match in _placeholder_regex.finditer(source):
+            self.literals.append(source[position:match.start()])
+            self.names.append(match.group(1))
+            position = match.end()
+        self.literals.append(source[position:])
+
+    def __str__(self):
+        return self.source
+
+    def render(self, variables: dict, undefined: str = "error") -> str:
+        if not self.names:
+            return self.source
+
+        parts = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            if name in variables:
+                value = variables[name]
+            else:
+                if undefined == "error":
+                    raise UndefinedVariableError(f"Undefined variable {{{{{name}}}}} in: {self.source!r}")
+                if undefined == "warn":
+                    logger.print(f"Warning: undefined variable {{{{{name}}}}}")
+                value = "{{" + name + "}}"
+            parts.append(value if isinstance(value, str) else str(value))
+            parts.append(literal)
+        return "".join(parts)
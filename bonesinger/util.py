@@ -1,11 +1,12 @@
+import asyncio
 import random
 import string
+from .template import Template
 
 
 def strong_key_format(line, keys):
-    for key, value in keys.items():
-        line = line.replace("{{" + key + "}}", value)
-    return line
+    """Substitute known {{keys}} in line, keep unknown placeholders."""
+    return Template(line).render(keys, undefined="keep")
 
 
 def merge_dicts(*dict_args):
@@ -31,3 +32,18 @@ def merge_dicts_and_lists(*dict_args):
 
 def generate_random_string(length=8):
     return ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
+
+
+async def read_lines(stream):
+    """Yield lines of asyncio stream as soon as they are complete.
+    Lines longer than stream limit are yielded in limit-sized pieces."""
+    while True:
+        try:
+            line = await stream.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                yield e.partial
+            return
+        except asyncio.LimitOverrunError as e:
+            line = await stream.read(e.consumed)
+        yield line
@@ -0,0 +1,210 @@
+import asyncio
+import http.server
+import io
+import json
+import os
+import socketserver
+import struct
+import tarfile
+import tempfile
+import threading
+import unittest
+
+from bonesinger import docker
+from bonesinger.docker_api import DockerClient, DockerAPIError, demux_frames
+
+
+def frame(stream, payload):
+    return struct.pack(">BxxxL", stream, len(payload)) + payload
+
+
+class FakeEngineHandler(http.server.BaseHTTPRequestHandler):
+    """Canned answers of Docker Engine API; the server records requests."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = self.rfile.read(length) if length else b""
+        return json.loads(data) if data else None
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        body = self.read_body()
+        self.server.requests.append(("POST", self.path, body))
+        if path == "/v1.41/containers/create":
+            self.send_json(201, {"Id": "c0ffee", "Warnings": []})
+        elif path.endswith("/start") and path.startswith("/v1.41/containers/"):
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif path.endswith("/exec") and path.startswith("/v1.41/containers/missing"):
+            self.send_json(404, {"message": "No such container: missing"})
+        elif path.endswith("/exec"):
+            self.server.exec_cmd = body["Cmd"]
+            self.server.exec_stdin = body.get("AttachStdin", False)
+            self.send_json(201, {"Id": "e1"})
+        elif path == "/v1.41/exec/e1/start":
+            # raw multiplexed stream until the connection is closed
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.docker.raw-stream")
+            self.end_headers()
+            for chunk in self.server.exec_chunks:
+                self.wfile.write(chunk)
+                self.wfile.flush()
+            if self.server.exec_stdin:
+                # echo stdin of the command until the client half-closes
+                self.wfile.write(frame(1, self.rfile.read()))
+            self.close_connection = True
+        else:
+            self.send_json(404, {"message": "page not found"})
+
+    def do_PUT(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.server.archive = self.rfile.read(length)
+        self.server.requests.append(("PUT", self.path, None))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path, None))
+        if self.path == "/v1.41/exec/e1/json":
+            self.send_json(200, {"ExitCode": self.server.exit_code, "Running": False})
+        else:
+            self.send_json(404, {"message": "page not found"})
+
+
+class FakeEngine(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        super().__init__(path, FakeEngineHandler)
+        self.requests = []
+        self.exec_cmd = None
+        self.exec_chunks = []
+        self.exec_stdin = False
+        self.exit_code = 0
+
+
+class DockerClientTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.directory.name, "docker.sock")
+        self.engine = FakeEngine(self.socket_path)
+        threading.Thread(target=self.engine.serve_forever, daemon=True).start()
+        self.client = DockerClient(self.socket_path)
+
+    def tearDown(self):
+        self.client.close()
+        self.engine.shutdown()
+        self.engine.server_close()
+        self.directory.cleanup()
+
+    def test_create_and_start_container(self):
+        container_id = self.client.create_container("alpine", ["sh"], "box",
+                                                    config={"Env": ["A=1"]},
+                                                    host_config={"Privileged": True})
+        self.client.start_container("box")
+        self.assertEqual(container_id, "c0ffee")
+        method, path, body = self.engine.requests[0]
+        self.assertEqual(path, "/v1.41/containers/create?name=box")
+        self.assertEqual(body["Image"], "alpine")
+        self.assertEqual(body["Env"], ["A=1"])
+        self.assertEqual(body["HostConfig"], {"Privileged": True})
+        self.assertEqual(self.engine.requests[1][:2], ("POST", "/v1.41/containers/box/start"))
+
+    def test_exec_run_demuxes_output(self):
+        self.engine.exec_chunks = [frame(1, b"out\n") + frame(2, b"err\n")]
+        self.engine.exit_code = 3
+        exit_code, output = self.client.exec_run("box", ["true"], workdir="/w")
+        self.assertEqual(exit_code, 3)
+        self.assertEqual(output, "out\nerr\n")
+
+    def test_exec_output_separates_streams(self):
+        self.engine.exec_chunks = [frame(1, b"abc\n") + frame(2, b"fatal: x\n") + frame(1, b"d")]
+        self.engine.exit_code = 128
+        self.assertEqual(self.client.exec_output("box", ["git", "status"]),
+                         (128, "abc\nd", "fatal: x\n"))
+
+    def test_exec_stream_splits_lines_across_frames_and_chunks(self):
+        data = frame(1, b"first li") + frame(2, b"ne\nsecond\nthi") + frame(1, b"rd")
+        # chunks of the raw stream do not follow frame boundaries
+        self.engine.exec_chunks = [data[:5], data[5:13], data[13:]]
+        lines = []
+        exit_code = asyncio.run(self.client.exec_stream("box", ["sh", "script"], None, lines.append))
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(lines, ["first line\n", "second\n", "third"])
+
+    def test_exec_stream_writes_stdin(self):
+        lines = []
+        script = b"echo a\n" * 20000
+        exit_code = asyncio.run(self.client.exec_stream("box", ["sh"], None, lines.append,
+                                                        stdin_data=script))
+        self.assertEqual(exit_code, 0)
+        self.assertTrue(self.engine.exec_stdin)
+        self.assertEqual("".join(lines), script.decode("utf-8"))
+
+    def test_upload_data(self):
+        self.client.upload_data("box", b"echo a\n", "/tmp/s.tmp")
+        method, path, _ = self.engine.requests[0]
+        self.assertEqual((method, path), ("PUT", "/v1.41/containers/box/archive?path=%2Ftmp"))
+        with tarfile.open(fileobj=io.BytesIO(self.engine.archive)) as tar:
+            self.assertEqual(tar.getnames(), ["s.tmp"])
+            self.assertEqual(tar.extractfile("s.tmp").read(), b"echo a\n")
+
+    def test_error_message(self):
+        with self.assertRaises(DockerAPIError) as context:
+            self.client.exec_run("missing", ["true"])
+        self.assertEqual(context.exception.status, 404)
+        self.assertIn("No such container: missing", str(context.exception))
+
+    def test_exec_in_container_runs_shell(self):
+        self.engine.exec_chunks = [frame(1, b"b\n")]
+        docker.use_docker_api(self.socket_path)
+        try:
+            output = docker.exec_in_docker_container("box", "echo a | tr a b")
+        finally:
+            docker.docker_api_client().close()
+            docker._api_client = None
+        self.assertEqual(self.engine.exec_cmd, ["sh", "-c", "echo a | tr a b"])
+        self.assertEqual(output, "b")
+
+
+class ImageRepositoryTest(unittest.TestCase):
+    def test_tag_and_registry_port(self):
+        self.assertEqual(docker.image_repository("env"), "env")
+        self.assertEqual(docker.image_repository("env:1"), "env")
+        self.assertEqual(docker.image_repository("localhost:5000/env"), "localhost:5000/env")
+        self.assertEqual(docker.image_repository("localhost:5000/team/env:1"), "localhost:5000/team/env")
+        self.assertEqual(docker.image_repository("env@sha256:abc"), "env")
+
+
+class DemuxFramesTest(unittest.TestCase):
+    def test_partial_frame_is_kept(self):
+        data = frame(1, b"abc") + frame(2, b"defg")
+        frames, tail = demux_frames(data[:-2])
+        self.assertEqual(frames, [(1, b"abc")])
+        frames, tail = demux_frames(tail + data[-2:])
+        self.assertEqual(frames, [(2, b"defg")])
+        self.assertEqual(tail, b"")
+
+    def test_partial_header_is_kept(self):
+        frames, tail = demux_frames(frame(1, b"x")[:5])
+        self.assertEqual(frames, [])
+        self.assertEqual(len(tail), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from bonesinger.git_cache import GitMirrorCache
+
+
+class GitMirrorCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.origin = os.path.join(self.directory.name, "origin")
+        for args in (["init", "-q", self.origin],
+                     ["-C", self.origin, "-c", "user.name=t", "-c", "user.email=t@t",
+                      "commit", "-q", "--allow-empty", "-m", "init"]):
+            subprocess.run(["git"] + args, check=True)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_concurrent_callers_wait_for_mirror(self):
+        cache = GitMirrorCache(os.path.join(self.directory.name, "cache"))
+        results = []
+
+        def update():
+            path = cache.update_mirror(self.origin)
+            results.append(os.path.exists(os.path.join(path, "HEAD")))
+
+        threads = [threading.Thread(target=update) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 4)
+
+    def test_failed_update_is_retried(self):
+        cache = GitMirrorCache(os.path.join(self.directory.name, "cache"))
+        missing = os.path.join(self.directory.name, "missing")
+        with self.assertRaises(Exception):
+            cache.update_mirror(missing)
+        os.rename(self.origin, missing)
+        path = cache.update_mirror(missing)
+        self.assertTrue(os.path.exists(os.path.join(path, "HEAD")))
+
+
+if __name__ == "__main__":
+    unittest.main()
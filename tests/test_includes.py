@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import http.server
+import json
+import tempfile
+import threading
+import time
+import unittest
+
+from bonesinger.includes import HttpCache, IncludeResolver
+
+
+def parse(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest(), \
+        {"dict": json.loads(content), "line_includes": []}
+
+
+class IncludeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves server.documents with ETags; slow paths take server.delay."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            if self.path.startswith("/slow"):
+                time.sleep(server.delay)
+            if self.path not in server.documents:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = server.documents[self.path].encode("utf-8")
+            etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+class IncludeResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), IncludeHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+        self.server.delay = 0.3
+        self.server.documents = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.cache_directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache_directory.cleanup()
+
+    def resolve(self, paths, offline=False):
+        resolver = IncludeResolver(parse, HttpCache(self.cache_directory.name, offline=offline))
+        return asyncio.run(resolver.resolve(paths))
+
+    def test_etag_revalidation_uses_cached_copy(self):
+        self.server.documents["/main.json"] = json.dumps({"a": 1})
+        dicts, sources = self.resolve([self.base + "/main.json"])
+        self.assertEqual(dicts, [{"a": 1}])
+
+        cache = HttpCache(self.cache_directory.name)
+        entry = cache.load(self.base + "/main.json")
+        self.assertIsNotNone(entry["etag"])
+        # a 304 answer must give the cached content back
+        entry["content"] = json.dumps({"a": "cached"})
+        cache.store(self.base + "/main.json", entry["content"], entry["etag"], None)
+        dicts, _ = self.resolve([self.base + "/main.json"])
+        self.assertEqual(dicts, [{"a": "cached"}])
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_includes_are_fetched_concurrently_in_merge_order(self):
+        names = ["/slow1.json", "/slow2.json", "/slow3.json"]
+        for index, name in enumerate(names):
+            self.server.documents[name] = json.dumps({"n": index})
+        self.server.documents["/main.json"] = json.dumps(
+            {"include": [self.base + name for name in names], "main": True})
+
+        start = time.time()
+        dicts, sources = self.resolve([self.base + "/main.json"])
+        elapsed = time.time() - start
+
+        self.assertEqual(dicts[:3], [{"n": 0}, {"n": 1}, {"n": 2}])
+        self.assertTrue(dicts[3]["main"])
+        self.assertEqual([url for url, _ in sources],
+                         [self.base + name for name in names] + [self.base + "/main.json"])
+        self.assertEqual(self.server.max_in_flight, 3)
+        self.assertLess(elapsed, 3 * self.server.delay)
+
+    def test_missing_include_fails(self):
+        self.server.documents["/main.json"] = json.dumps({"include": [self.base + "/missing.json"]})
+        with self.assertRaises(Exception) as context:
+            self.resolve([self.base + "/main.json"])
+        self.assertIn("404", str(context.exception))
+
+    def test_offline_mode(self):
+        url = self.base + "/main.json"
+        with self.assertRaises(Exception) as context:
+            self.resolve([url], offline=True)
+        self.assertIn("Offline mode", str(context.exception))
+
+        self.server.documents["/main.json"] = json.dumps({"a": 1})
+        self.resolve([url])
+        del self.server.documents["/main.json"]
+        dicts, _ = self.resolve([url], offline=True)
+        self.assertEqual(dicts, [{"a": 1}])
+        # only the online resolution reached the server
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_unreachable_server_falls_back_to_cached_copy(self):
+        url = self.base + "/main.json"
+        self.server.documents["/main.json"] = json.dumps({"a": 1})
+        self.resolve([url])
+        self.server.shutdown()
+        self.server.server_close()
+        dicts, _ = self.resolve([url])
+        self.assertEqual(dicts, [{"a": 1}])
+
+    def test_include_cycle(self):
+        self.server.documents["/a.json"] = json.dumps({"include": [self.base + "/b.json"]})
+        self.server.documents["/b.json"] = json.dumps({"include": [self.base + "/a.json"]})
+        with self.assertRaises(Exception) as context:
+            self.resolve([self.base + "/a.json"])
+        self.assertIn("Include cycle", str(context.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
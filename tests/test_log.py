@@ -0,0 +1,79 @@
+import asyncio
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+from bonesinger.log import LogWriter, Logger
+
+
+class SlowConsole(io.StringIO):
+    def write(self, text):
+        time.sleep(0.001)
+        return super().write(text)
+
+
+class LogWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.stdout = sys.stdout
+        sys.stdout = SlowConsole()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        self.directory.cleanup()
+
+    def start_writer(self, **options):
+        writer = LogWriter(self.directory.name, "log-test.jsonl", "run", batch_size=10, **options)
+        writer.start()
+        return writer
+
+    def read_lines(self):
+        with open(os.path.join(self.directory.name, "log-test.jsonl")) as f:
+            return [json.loads(line)["line"] for line in f]
+
+    def test_output_reader_is_held_back(self):
+        writer = self.start_writer(high_water=50, max_queue=100)
+        logger = Logger()
+        logger.writer = writer
+        sizes = []
+
+        async def produce():
+            for index in range(2000):
+                logger.print(f"line {index}", stream="output")
+                sizes.append(writer.queue.qsize())
+                await logger.drain()
+
+        asyncio.run(produce())
+        writer.stop()
+        lines = self.read_lines()
+        self.assertEqual([line for line in lines if line.startswith("line ")],
+                         [f"line {index}" for index in range(2000)])
+        self.assertLessEqual(max(sizes), 100)
+        self.assertEqual(writer.dropped, 0)
+
+    def test_overflow_in_event_loop_is_dropped_and_reported(self):
+        writer = self.start_writer(high_water=50, max_queue=100)
+
+        async def produce():
+            # without drain; put must not block the loop
+            for index in range(2000):
+                writer.put((time.time(), {}, "output", f"line {index}"))
+
+        start = time.time()
+        asyncio.run(produce())
+        self.assertLess(time.time() - start, 1.0)
+        writer.stop()
+        self.assertGreater(writer.dropped, 0)
+        lines = self.read_lines()
+        self.assertEqual(len([line for line in lines if line.startswith("line ")]),
+                         2000 - writer.dropped)
+        self.assertTrue(any(line.endswith("log records dropped, log writer queue is full")
+                            for line in lines))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+from bonesinger.step import parse_needs_record, strip_trace
+
+
+class ParseNeedsRecordTest(unittest.TestCase):
+    def test_duplicates_are_removed_in_order(self):
+        self.assertEqual(parse_needs_record(["b", "a", "b"], "s"), ["b", "a"])
+
+    def test_missing_means_previous_step(self):
+        self.assertIsNone(parse_needs_record(None, "s"))
+
+    def test_invalid_records(self):
+        for record in ("build", {"a": 1}, [1], ["a", None]):
+            with self.assertRaises(Exception) as context:
+                parse_needs_record(record, "s")
+            self.assertIn("list of step names", str(context.exception))
+
+
+class StripTraceTest(unittest.TestCase):
+    def test_trace_lines_are_removed(self):
+        self.assertEqual(strip_trace("+ echo a\na\n++ echo b\nb\n"), "a\nb\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import glob
+import os
+import tempfile
+import unittest
+
+from bonesinger.capture import FullCapture
+from bonesinger.executors import NativeExecutor
+from bonesinger.step_cache import StepCache, glob_base, match_inputs
+
+FILES = ["a.txt", "b.c", "src/x.c", "src/y.h", "src/sub/z.c", "src/sub/deep/w.c",
+         ".hidden.c", "src/.h.c", ".git/o.c", "docs/r1.md", "docs/ra.md", "x/y/z.txt"]
+
+PATTERNS = ["*.c", "**/*.c", "src/*.c", "src/**", "**", "src/**/*.c", "a.txt",
+            "docs/r[0-9].md", "docs/r[!0-9]*", "?.c", "x/**/*.txt", "missing/*.c", "src/sub"]
+
+
+class MatchInputsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        for name in FILES:
+            path = os.path.join(self.directory.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_same_files_as_recursive_glob(self):
+        for pattern in PATTERNS:
+            expected = sorted(os.path.relpath(path, self.directory.name)
+                              for path in glob.glob(os.path.join(self.directory.name, pattern),
+                                                    recursive=True)
+                              if os.path.isfile(path))
+            self.assertEqual(match_inputs(FILES, [pattern]), expected, pattern)
+
+    def test_glob_base(self):
+        self.assertEqual(glob_base("**/*.c"), ".")
+        self.assertEqual(glob_base("src/sub/*.c"), "src/sub")
+        self.assertEqual(glob_base("a.txt"), "a.txt")
+
+    def test_native_hash_inputs(self):
+        executor = NativeExecutor("/bin/sh")
+        executor.chdir(self.directory.name)
+        first = executor.hash_inputs(["src/**/*.c"])
+        self.assertEqual(first, executor.hash_inputs(["src/*.c", "src/sub/**/*.c"]))
+        with open(os.path.join(self.directory.name, "src/y.h"), "w") as f:
+            f.write("changed")
+        self.assertEqual(first, executor.hash_inputs(["src/**/*.c"]))
+        with open(os.path.join(self.directory.name, "src/sub/deep/w.c"), "w") as f:
+            f.write("changed")
+        self.assertNotEqual(first, executor.hash_inputs(["src/**/*.c"]))
+
+
+class StepCacheTest(unittest.TestCase):
+    def test_eviction_keeps_recent_entries(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = StepCache(directory, max_size=4000)
+            keys = [f"{index:02x}" + "0" * 62 for index in range(10)]
+            for index, key in enumerate(keys):
+                cache.store(key, ["x" * 500], "p", "s")
+                os.utime(cache.entry_path(key), (index, index))
+                self.assertLessEqual(cache.size, cache.max_size)
+            self.assertIsNone(cache.load(keys[0]))
+            with cache.load(keys[-1]) as f:
+                self.assertEqual(f.read(), "x" * 500)
+            self.assertEqual(cache.size, cache.scan()[1])
+
+    def test_spilled_capture_is_stored_and_replayed_by_lines(self):
+        capture = FullCapture(max_memory=100)
+        lines = [f"line {index}\n" for index in range(1000)]
+        for line in lines:
+            capture.append(line)
+        self.assertIsNotNone(capture.file)
+        with tempfile.TemporaryDirectory() as directory:
+            cache = StepCache(directory)
+            cache.store("ab" + "0" * 62, capture.iter_chunks(size=64), "p", "s")
+            capture.close()
+            with cache.load("ab" + "0" * 62) as f:
+                self.assertEqual(list(f), lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
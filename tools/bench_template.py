@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""Compare per-line str.replace substitution (former strong_key_format)
+with compiled Template rendering on a large generated script."""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from bonesinger.template import Template  # noqa: E402
+
+
+def replace_format(line, keys):
+    for key, value in keys.items():
+        line = line.replace("{{" + key + "}}", value)
+    return line
+
+
+def main():
+    keys = {f"key{i}": f"value{i}" for i in range(50)}
+    lines = [f"cmake --build {{{{key{i % 50}}}}} --target t{i} -j{{{{key{(i * 7) % 50}}}}}"
+             for i in range(5000)]
+    text = "\n".join(lines)
+
+    template = Template(text)
+    assert template.render(keys) == "\n".join(replace_format(line, keys) for line in lines)
+
+    repeat = 20
+    replace_time = timeit.timeit(lambda: [replace_format(line, keys) for line in lines], number=repeat)
+    compile_time = timeit.timeit(lambda: Template(text), number=repeat)
+    render_time = timeit.timeit(lambda: template.render(keys), number=repeat)
+
+    print(f"{len(lines)} lines, {len(keys)} keys, {repeat} renders")
+    print(f"str.replace per line: {replace_time:.3f}s")
+    print(f"Template compile:     {compile_time:.3f}s (once per step at parse time)")
+    print(f"Template render:      {render_time:.3f}s")
+
+
+if __name__ == "__main__":
+    main()